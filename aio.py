@@ -0,0 +1,173 @@
+import asyncio
+import atexit
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyemi.instruments import BaseInstrument, SpectrumAnalyzer, SignalGenerator, Tower, Turntable, DualController
+
+
+class _Channel:
+    '''Worker thread and lock that serialize all access to one VISA resource'''
+    def __init__(self, resource_string):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'pyemi {resource_string}')
+        self._locks = {}
+
+    @property
+    def lock(self):
+        # asyncio locks belong to the event loop they are first used in
+        loop = asyncio.get_running_loop()
+        if loop not in self._locks:
+            self._locks[loop] = asyncio.Lock()
+        return self._locks[loop]
+
+
+_channels = {}
+_channels_lock = threading.Lock()
+
+
+def _channel(resource_string):
+    with _channels_lock:
+        if resource_string not in _channels:
+            _channels[resource_string] = _Channel(resource_string)
+        return _channels[resource_string]
+
+
+@atexit.register
+def close_channels():
+    '''Stops the worker threads of every resource'''
+    with _channels_lock:
+        for channel in _channels.values():
+            channel.executor.shutdown(wait=False)
+        _channels.clear()
+
+
+class AsyncBaseInstrument:
+    '''Awaitable wrapper around an instrument.
+
+    Blocking pyvisa calls run in a worker thread per VISA resource, so
+    several instruments can be driven concurrently from one event loop.
+    Instruments that share a resource string share the worker and lock.
+    '''
+    instrument_class = BaseInstrument
+
+    def __init__(self, instrument=None, **kwargs):
+        self.instrument = instrument if instrument is not None else self.instrument_class(**kwargs)
+        self._channel = _channel(self.instrument.resource_string)
+
+    async def run(self, function, *args, **kwargs):
+        '''Runs function(*args, **kwargs) in the resource's worker thread and returns its result'''
+        loop = asyncio.get_running_loop()
+        async with self._channel.lock:
+            return await loop.run_in_executor(self._channel.executor, functools.partial(self._call, function, *args, **kwargs))
+
+    def _call(self, function, *args, **kwargs):
+        # The session stays open while the worker is blocked in it
+        with self.instrument.pool.in_use(self.instrument.resource_string):
+            return function(*args, **kwargs)
+
+    async def write(self, command):
+        return await self.run(self.instrument.write, command)
+
+    async def query(self, command, parse=None):
+        return await self.run(self.instrument.query, command, parse)
+
+    async def get(self, name):
+        '''Reads an instrument property, e.g. await sa.get('start_frequency')'''
+        return await self.run(getattr, self.instrument, name)
+
+    async def set(self, name, value):
+        '''Writes an instrument property, e.g. await sa.set('start_frequency', (1, 'MHz'))'''
+        return await self.run(setattr, self.instrument, name, value)
+
+    async def reset(self):
+        return await self.run(self.instrument.reset)
+
+    async def opc(self):
+        return await self.run(self.instrument.opc)
+
+    async def operation_complete(self):
+        return await self.run(self.instrument.operation_complete)
+
+    async def wait_complete(self, timeout=None, interval=0.005, max_interval=0.5, **kwargs):
+        '''Arms completion reporting and polls it without blocking the event loop,
+        doubling the interval between polls up to max_interval'''
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        await self.run(self.instrument.arm_complete)
+        while not await self.operation_complete(**kwargs):
+            if deadline is not None and loop.time() + interval > deadline:
+                raise asyncio.TimeoutError(f'{self.instrument.resource_string} did not complete within {timeout} s')
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def __getattr__(self, name):
+        # Plain attributes such as commands and resource_string
+        if name == 'instrument':
+            raise AttributeError(name)
+        return getattr(self.instrument, name)
+
+
+class AsyncSpectrumAnalyzer(AsyncBaseInstrument):
+    instrument_class = SpectrumAnalyzer
+
+    async def array(self, t, delay=None):
+        '''Reads trace t as a numpy array'''
+        return await self.run(lambda: self.instrument.Trace(t).array(delay=delay))
+
+    async def result(self, t, delay=None, out=None):
+        '''Reads trace t as a TraceResult'''
+        return await self.run(lambda: self.instrument.Trace(t).result(delay=delay, out=out))
+
+    async def dataframe(self, t, delay=None):
+        '''Reads trace t as a pandas dataframe'''
+        return await self.run(lambda: self.instrument.Trace(t).dataframe(delay=delay))
+
+    async def sweep(self, t=1):
+        '''Triggers a single sweep and reads trace t once it completes'''
+        def sweep():
+            self.instrument.write(self.instrument.command('sweep.mode.single'))
+            self.instrument.write(self.instrument.command('sweep.start'))
+            return self.instrument.Trace(t).array()
+        return await self.run(sweep)
+
+
+class AsyncSignalGenerator(AsyncBaseInstrument):
+    instrument_class = SignalGenerator
+
+
+class AsyncTower(AsyncBaseInstrument):
+    instrument_class = Tower
+
+    async def move(self, position, wait=True, timeout=None):
+        '''Sets the position and optionally waits for the move to complete'''
+        await self.set('position', position)
+        if wait:
+            await self.wait_complete(timeout)
+
+
+class AsyncTurntable(AsyncTower):
+    instrument_class = Turntable
+
+
+class AsyncDualController(AsyncBaseInstrument):
+    '''Tower and turntable share one controller, so the device is selected inside each call'''
+    instrument_class = DualController
+
+    def _on(self, device, function, *args):
+        self.instrument.device = device
+        return function(*args)
+
+    async def opc(self, device=None):
+        if device is None:
+            return await self.run(self.instrument.opc)
+        return await self.run(self._on, device, self.instrument.opc)
+
+    async def operation_complete(self, device=None):
+        return bool(await self.opc(device))
+
+    async def move(self, device, position, wait=True, timeout=None):
+        '''Moves the tower or turntable and optionally waits for it to arrive'''
+        await self.run(self._on, device, setattr, self.instrument, 'position', position)
+        if wait:
+            await self.wait_complete(timeout, device=device)
@@ -0,0 +1,48 @@
+'''Checks that a cold `import pyemi` stays fast and leaves heavy dependencies unloaded.
+
+Run with pyemi importable, e.g. after `pip install .`:
+
+    python benchmarks/import_time.py [budget in ms]
+
+Exits with 1 if the best of several cold imports exceeds the budget.
+'''
+import subprocess
+import sys
+
+BUDGET_MS = 100
+RUNS = 5
+DEFERRED = ['numpy', 'pandas', 'pyvisa', 'ruamel.yaml']
+
+SCRIPT = f'''
+import sys, time
+start = time.perf_counter()
+import pyemi
+elapsed = time.perf_counter() - start
+print(elapsed * 1000)
+print(','.join(m for m in {DEFERRED!r} if m in sys.modules))
+'''
+
+
+def cold_import():
+    output = subprocess.run([sys.executable, '-c', SCRIPT], check=True, capture_output=True, text=True).stdout
+    elapsed, loaded = output.splitlines()[:2] if '\n' in output.strip() else (output.strip(), '')
+    return float(elapsed), [m for m in loaded.split(',') if m]
+
+
+def main(budget_ms=BUDGET_MS):
+    results = [cold_import() for _ in range(RUNS)]
+    best = min(elapsed for elapsed, loaded in results)
+    loaded = results[0][1]
+    print(f'import pyemi: best {best:.1f} ms of {RUNS} cold imports, budget {budget_ms} ms')
+    failed = False
+    if loaded:
+        print(f'Loaded at import time, should be deferred: {", ".join(loaded)}')
+        failed = True
+    if best > budget_ms:
+        print('Import time is over budget')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS))
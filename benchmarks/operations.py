@@ -0,0 +1,129 @@
+'''Times the main instrument operations against simulated instruments.
+
+Run with pyemi importable, e.g. after `pip install .`:
+
+    python benchmarks/operations.py [repeats]
+
+Each operation runs on a simulated GPIB bus and reports its bus
+transactions, bytes moved and wall time.  Exits with 1 if an operation
+takes more transactions than its budget, so changes that add round trips
+show up without a lab.  Operations that check their results, such as
+leveling, raise AssertionError on a wrong one.
+'''
+import sys
+import time
+
+from pyemi.immunity import Leveler
+from pyemi.instruments import SpectrumAnalyzer, SignalGenerator, DualController
+from pyemi.simulation import simulate
+
+REPEATS = 5
+ANALYZER = 'GPIB0::20::INSTR'
+SERIAL_ANALYZER = 'ASRL1::INSTR'
+CONTROLLER = 'GPIB0::7::INSTR'
+GENERATOR = 'GPIB0::28::INSTR'
+# GPIB with a fast instrument, about 1 ms per transaction and 1 MB/s
+MODEL = {'latency': 0.001, 'bandwidth': 1e6, 'sweep_time': 0.02}
+
+# Most bus transactions each operation may take, writes and reads counted separately
+BUDGETS = {
+    'dataframe() binary': 9,
+    'dataframe() ascii': 9,
+    'setup unbatched': 6,
+    'setup batched': 1,
+    'segmented_sweep() 3 segments': 24,
+    'move_to() 20 degrees': 12,
+    'level() compressed amplifier': 30,
+}
+
+
+def setup(sa):
+    sa.start_frequency = (30, 'MHz')
+    sa.stop_frequency = (1, 'GHz')
+    sa.rbw = (120, 'kHz')
+    sa.vbw = (300, 'kHz')
+    sa.sweep_points = 10001
+    sa.amplitude_units = 'DBUV'
+
+
+def batched_setup(sa):
+    with sa.batch():
+        setup(sa)
+
+
+def segmented_sweep(sa):
+    sa.segmented_sweep([
+        {'start': 150e3, 'stop': 30e6, 'rbw': 9e3, 'points': 4001},
+        {'start': 30e6, 'stop': 1e9, 'rbw': 120e3, 'points': 10001},
+        {'start': 1e9, 'stop': 6e9, 'rbw': 1e6, 'points': 10001},
+    ])
+
+
+def move(controller):
+    controller.device = 'turntable'
+    position = controller.read_position()
+    controller.move_to(position + 20 if position < 180 else position - 20)
+
+
+def compressed(sg):
+    '''Returns a reading of the generator's level through 40 dB of gain compressing above 10 dBm'''
+    def measure(frequency):
+        output = float(sg.level) + 40
+        return output if output < 10 else 10 + 0.1 * (output - 10)
+    return measure
+
+
+def level(leveler, sg):
+    # Leveling stops short of the target here, the result must still be the level last set
+    for frequency in (100e6, 200e6):
+        result, reading, iterations = leveler.level(frequency)
+        if result != float(sg.level) or reading != leveler.measure(frequency):
+            raise AssertionError(f'level() returned {result} dBm but the generator is at {sg.level} dBm')
+
+
+def measure(rm, name, operation, repeats):
+    rm.reset_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        operation()
+    elapsed = (time.perf_counter() - start) / repeats
+    stats = {key: value / repeats for key, value in rm.stats().items()}
+    return name, elapsed, stats
+
+
+def main(repeats=REPEATS):
+    rm = simulate({
+        ANALYZER: 'esw.yaml', SERIAL_ANALYZER: 'esw.yaml', CONTROLLER: 'emcenter.yaml', GENERATOR: 'smw200a.yaml',
+    }, **MODEL)
+    sa = SpectrumAnalyzer(resource=ANALYZER, driver='esw.yaml')
+    serial = SpectrumAnalyzer(resource=SERIAL_ANALYZER, driver='esw.yaml')
+    controller = DualController(resource=CONTROLLER, driver='emcenter.yaml')
+    controller.device = 'turntable'
+    controller.speed = 200
+    sg = SignalGenerator(resource=GENERATOR, driver='smw200a.yaml')
+    leveler = Leveler(sg, sa, target=13, max_iterations=3, measure=compressed(sg))
+
+    operations = [
+        ('dataframe() binary', lambda: sa.Trace(1).dataframe()),
+        ('dataframe() ascii', lambda: serial.Trace(1).dataframe()),
+        ('setup unbatched', lambda: setup(sa)),
+        ('setup batched', lambda: batched_setup(sa)),
+        ('segmented_sweep() 3 segments', lambda: segmented_sweep(sa)),
+        ('move_to() 20 degrees', lambda: move(controller)),
+        ('level() compressed amplifier', lambda: level(leveler, sg)),
+    ]
+
+    print(f'{"operation":<30} {"transactions":>12} {"bytes":>10} {"bus ms":>8} {"wall ms":>8}')
+    failed = False
+    for name, operation in operations:
+        name, elapsed, stats = measure(rm, name, operation, repeats)
+        moved = stats['bytes_written'] + stats['bytes_read']
+        print(f'{name:<30} {stats["transactions"]:>12.1f} {moved:>10.0f} {stats["bus_time"] * 1000:>8.1f} {elapsed * 1000:>8.1f}')
+        if stats['transactions'] > BUDGETS.get(name, float('inf')):
+            print(f'{name} is over its budget of {BUDGETS[name]} transactions')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else REPEATS))
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+# Bump when the compiled format changes so stale disk caches are ignored
+CACHE_VERSION = 2
+
+# Top level driver settings that are not commands
+SETTINGS = {'language', 'query_delay', 'write_termination', 'max_message_length'}
+
+_placeholder = re.compile(r'%(?:\([^)]*\))?[-#0 +]*(?:\d+|\*)?(?:\.(?:\d+|\*))?([a-zA-Z%])')
+_dummy = {'d': 0, 'i': 0, 'u': 0, 'o': 0, 'x': 0, 'X': 0, 'c': 'A',
+          'e': 0.0, 'E': 0.0, 'f': 0.0, 'F': 0.0, 'g': 0.0, 'G': 0.0,
+          's': '', 'r': '', 'a': ''}
+
+_compiled = {}
+
+
+class DriverError(Exception):
+    pass
+
+
+class CommandString(str):
+    '''A formatted command that remembers the driver key it came from, e.g. frequency.start.set'''
+    def __new__(cls, text, key):
+        command = str.__new__(cls, text)
+        command.key = key
+        return command
+
+
+class Command:
+    '''A driver command template bound to its key, called with the placeholder values'''
+    __slots__ = ('key', 'template', 'arity')
+
+    def __init__(self, key, template):
+        self.key = key
+        self.template = template
+        conversions = [c for c in _placeholder.findall(template) if c != '%']
+        for conversion in conversions:
+            if conversion not in _dummy:
+                raise DriverError(f'{key}: unsupported placeholder %{conversion} in {template!r}')
+        self.arity = len(conversions)
+        try:
+            template % tuple(_dummy[c] for c in conversions)
+        except (TypeError, ValueError) as e:
+            raise DriverError(f'{key}: invalid command template {template!r}, {e}')
+
+    def __call__(self, *args):
+        # Accepts the values separately or as one tuple, e.g. (1, 'MHz')
+        if len(args) == 1 and type(args[0]) is tuple:
+            args = args[0]
+        if len(args) != self.arity:
+            raise DriverError(f'{self.key} takes {self.arity} values for {self.template!r}, got {len(args)}')
+        if not args:
+            return CommandString(self.template, self.key)
+        return CommandString(self.template % args, self.key)
+
+    @property
+    def conversions(self):
+        '''Placeholder conversion characters in order, e.g. ['d', 's'] for FREQ %d%s'''
+        return [c for c in _placeholder.findall(self.template) if c != '%']
+
+    def __repr__(self):
+        return f'Command({self.key!r}, {self.template!r})'
+
+    def __getstate__(self):
+        return (self.key, self.template, self.arity)
+
+    def __setstate__(self, state):
+        self.key, self.template, self.arity = state
+
+    @classmethod
+    def from_state(cls, state):
+        '''Rebuilds a command validated when it was compiled, without checking the template again'''
+        command = cls.__new__(cls)
+        command.__setstate__(state)
+        return command
+
+
+def compile_commands(commands, prefix=''):
+    '''Flattens nested driver commands into a table of Commands keyed by dotted path, e.g. frequency.start.set'''
+    table = {}
+    for name, value in commands.items():
+        key = f'{prefix}{name}'
+        if isinstance(value, dict):
+            table.update(compile_commands(value, f'{key}.'))
+        elif isinstance(value, str) and key not in SETTINGS:
+            table[key] = Command(key, value)
+    return table
+
+
+def validate(table, arity, driver=''):
+    '''Checks the placeholder count of each command against the count the instrument calls it with'''
+    errors = []
+    for key, expected in arity.items():
+        if key in table and table[key].arity != expected:
+            errors.append(f'{key} has {table[key].arity} placeholders in {table[key].template!r}, expected {expected}')
+    if errors:
+        raise DriverError(f'Invalid driver {driver}: ' + '; '.join(errors))
+
+
+def cache_folder():
+    return Path(os.environ.get('PYEMI_CACHE', Path.home() / '.cache' / 'pyemi'))
+
+
+def compile_driver(path):
+    '''Returns (commands, table) for a driver file.
+
+    Drivers are parsed once per process, and the compiled form is cached on
+    disk as JSON keyed by a hash of the file, so later startups skip YAML
+    parsing.  JSON rather than pickle, so a file planted in a shared cache
+    folder cannot run code.
+    '''
+    path = Path(path)
+    source = path.read_bytes()
+    digest = hashlib.sha256(source).hexdigest()[:16]
+    key = (str(path), digest)
+    if key in _compiled:
+        return _compiled[key]
+
+    cached = cache_folder() / f'{path.stem}-{digest}-v{CACHE_VERSION}.json'
+    try:
+        with open(cached, 'r') as f:
+            data = json.load(f)
+        table = {state[0]: Command.from_state(tuple(state)) for state in data['table']}
+        _compiled[key] = (data['commands'], table)
+        return _compiled[key]
+    except (OSError, ValueError, KeyError, TypeError, IndexError):
+        pass
+
+    from ruamel.yaml import YAML
+    commands = YAML(typ='safe').load(source) or {}
+    compiled = (commands, compile_commands(commands))
+    _compiled[key] = compiled
+
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        temporary = cached.with_suffix(f'.{os.getpid()}.tmp')
+        with open(temporary, 'w') as f:
+            json.dump({'commands': commands, 'table': [c.__getstate__() for c in compiled[1].values()]}, f)
+        os.replace(temporary, cached)
+    except OSError as e:
+        logging.info(f'Could not cache compiled driver {path}: {e}')
+    return compiled
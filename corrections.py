@@ -0,0 +1,90 @@
+import logging
+from collections import OrderedDict
+from pathlib import Path
+
+from pyemi.instruments import FREQUENCY_UNITS
+from pyemi.lazy import LazyModule
+
+np = LazyModule('numpy', globals(), 'np')
+
+
+class Transducer:
+    '''Frequency dependent correction in dB, e.g. an antenna factor, cable loss or preamp gain.
+
+    Values are interpolated in log frequency and held constant beyond the
+    ends of the table.  Gains, such as a preamp's, are subtracted.
+    '''
+    def __init__(self, frequencies, values, name='', gain=False):
+        order = np.argsort(np.asarray(frequencies, dtype=np.float64))
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)[order]
+        self.values = np.asarray(values, dtype=np.float64)[order]
+        self.name = name
+        self.gain = gain
+
+    def __repr__(self):
+        return f'Transducer({self.name!r}, {self.frequencies.size} points)'
+
+    @classmethod
+    def load(cls, path, frequency_unit='Hz', name=None, gain=False):
+        '''Loads a table of frequency, dB rows from a CSV file, skipping header and comment lines'''
+        table = np.genfromtxt(path, delimiter=',', comments='#', usecols=(0, 1), invalid_raise=False)
+        table = table[~np.isnan(table).any(axis=1)]
+        scale = FREQUENCY_UNITS[frequency_unit.lower()]
+        return cls(table[:, 0] * scale, table[:, 1], name or Path(path).stem, gain)
+
+    def evaluate(self, frequencies):
+        '''Returns the correction to add at each frequency in Hz'''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        if frequencies.size and (frequencies[0] < self.frequencies[0] or frequencies[-1] > self.frequencies[-1]):
+            logging.info(f'{self.name}: sweep extends beyond the table, using the end values')
+        values = np.interp(np.log10(frequencies), np.log10(self.frequencies), self.values)
+        return -values if self.gain else values
+
+
+class Corrections:
+    '''Sum of transducer corrections applied to sweeps.
+
+    The summed correction for each sweep's (start, stop, points) grid is
+    computed once and kept in a small LRU cache, so correcting a sweep is a
+    single in-place add.  units, if given, names the corrected amplitude,
+    e.g. dBuV/m after an antenna factor.
+
+    Example:
+        sa.corrections = Corrections(
+            Transducer.load('antenna.csv', 'MHz'), Transducer.load('cable.csv', 'MHz'),
+            Transducer.load('preamp.csv', 'MHz', gain=True), units='dBuV/m')
+        df = t1.dataframe()
+    '''
+    cache_size = 32
+
+    def __init__(self, *transducers, units=None):
+        self.transducers = list(transducers)
+        self.units = units
+        self._cache = OrderedDict()
+
+    def add(self, transducer):
+        self.transducers.append(transducer)
+        self._cache.clear()
+
+    def vector(self, start, stop, points):
+        '''Returns the read only float32 correction for a sweep of points from start to stop Hz'''
+        key = (float(start), float(stop), int(points))
+        vector = self._cache.get(key)
+        if vector is not None:
+            self._cache.move_to_end(key)
+            return vector
+        frequencies = np.linspace(start, stop, int(points))
+        vector = np.zeros(int(points), dtype=np.float64)
+        for transducer in self.transducers:
+            vector += transducer.evaluate(frequencies)
+        vector = vector.astype(np.float32)
+        vector.setflags(write=False)
+        self._cache[key] = vector
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return vector
+
+    def apply(self, amplitudes, start, stop):
+        '''Adds the correction to amplitudes in place and returns them, the last axis is frequency'''
+        amplitudes += self.vector(start, stop, amplitudes.shape[-1])
+        return amplitudes
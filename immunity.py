@@ -0,0 +1,156 @@
+import logging
+from pathlib import Path
+
+from pyemi.lazy import LazyModule
+
+np = LazyModule('numpy', globals(), 'np')
+
+
+class Calibration:
+    '''Gain from generator level to measured level at each frequency, in dB.
+
+    Gains between calibrated frequencies are interpolated in log frequency.
+    Saved as an .npz file so later runs seed leveling from it.
+    '''
+    def __init__(self, frequencies=(), gains=(), target=None):
+        order = np.argsort(np.asarray(frequencies, dtype=np.float64))
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)[order]
+        self.gains = np.asarray(gains, dtype=np.float64)[order]
+        self.target = target
+
+    def __len__(self):
+        return self.frequencies.size
+
+    def gain(self, frequency):
+        '''Returns the expected gain at frequency in Hz, None without calibration data'''
+        if not len(self):
+            return None
+        return float(np.interp(np.log10(frequency), np.log10(self.frequencies), self.gains))
+
+    def update(self, frequencies, gains):
+        '''Merges new measurements, replacing gains at frequencies already calibrated'''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        keep = ~np.isin(self.frequencies, frequencies)
+        merged = Calibration(
+            np.concatenate([self.frequencies[keep], frequencies]),
+            np.concatenate([self.gains[keep], np.asarray(gains, dtype=np.float64)]), self.target)
+        self.frequencies, self.gains = merged.frequencies, merged.gains
+
+    def save(self, path):
+        np.savez(path, frequencies=self.frequencies, gains=self.gains, target=np.nan if self.target is None else self.target)
+
+    @classmethod
+    def load(cls, path):
+        '''Loads a saved calibration, an empty one if path does not exist'''
+        if not Path(path).exists():
+            return cls()
+        data = np.load(path)
+        target = float(data['target'])
+        return cls(data['frequencies'], data['gains'], None if np.isnan(target) else target)
+
+
+class Leveler:
+    '''Finds the generator level that gives a target reading at each frequency.
+
+    Each step is a secant step on the dB response, starting from a slope of
+    1 dB per dB.  The first level comes from the calibration, or the gain
+    found at the previous frequency, so a calibrated setup usually levels
+    with a single reading.  max_level caps the generator level to protect
+    amplifiers and the equipment under test.
+
+    Example:
+        leveler = Leveler(sg, sa, target=-20, calibration='cal.npz', max_level=0)
+        results = leveler.run(frequencies)
+        leveler.save()
+    '''
+    def __init__(self, sg, sa, target, tolerance=0.5, max_iterations=6, max_level=0.0, min_level=-130.0,
+                 calibration=None, measure=None, marker=1):
+        self.sg = sg
+        self.sa = sa
+        self.target = target
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.max_level = max_level
+        self.min_level = min_level
+        self.marker = marker
+        self.path = calibration if isinstance(calibration, (str, Path)) else None
+        if self.path is not None:
+            calibration = Calibration.load(self.path)
+        self.calibration = calibration if calibration is not None else Calibration()
+        self.measure = measure or self.read_analyzer
+        self.results = None
+
+    def read_analyzer(self, frequency):
+        '''Sweeps the analyzer around frequency and returns the peak marker level, in one transaction'''
+        sa = self.sa
+        with sa.batch():
+            # *WAI only waits for the sweep in single sweep mode
+            sa.write(sa.command('sweep.mode.single'))
+            sa.write(sa.command('frequency.center.set', frequency, 'Hz'))
+            sa.write(sa.command('sweep.start'))
+            sa.write(sa.command('marker.max', self.marker))
+            reading = sa.query(sa.command('marker.amplitude', self.marker), float)
+        sa.invalidate('frequency.start', 'frequency.stop', 'frequency.center')
+        return reading.result()
+
+    def set_level(self, level):
+        self.sg.level = f'{level:.2f}'
+
+    def level(self, frequency, gain=None):
+        '''Levels at one frequency, returns (generator level, reading, iterations).
+
+        The level returned is the one last set on the generator and reading
+        is taken at it, also when leveling stops without converging.
+        '''
+        self.sg.discrete_frequency = (frequency, 'Hz')
+        seed = self.calibration.gain(frequency)
+        gain = seed if seed is not None else gain
+        level = self.target - gain if gain is not None else self.min_level + 0.5 * (self.max_level - self.min_level)
+        slope = 1.0
+        previous = None
+        for iteration in range(1, self.max_iterations + 1):
+            # Rounded as set, so the level returned is exactly the generator's
+            level = round(min(max(level, self.min_level), self.max_level), 2)
+            self.set_level(level)
+            reading = self.measure(frequency)
+            error = self.target - reading
+            if abs(error) <= self.tolerance:
+                return level, reading, iteration
+            if level >= self.max_level and error > 0:
+                logging.warning(f'{frequency} Hz: target {self.target} needs more than the maximum level {self.max_level}')
+                return level, reading, iteration
+            if iteration == self.max_iterations:
+                break
+            if previous is not None and abs(level - previous[0]) > 1e-3:
+                # Compression and noise keep the slope within sensible bounds
+                slope = min(max((reading - previous[1]) / (level - previous[0]), 0.2), 2.0)
+            previous = (level, reading)
+            level += error / slope
+        logging.warning(f'{frequency} Hz: reading {reading} not within {self.tolerance} dB of {self.target} after {iteration} readings')
+        return level, reading, iteration
+
+    def run(self, frequencies):
+        '''Levels at each frequency in turn, each seeded from the last, and records the results.
+
+        Returns a structured array with frequency, level, reading and
+        iterations fields, and merges the gains into the calibration.
+        '''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        results = np.zeros(frequencies.size, dtype=[('frequency', 'f8'), ('level', 'f8'), ('reading', 'f8'), ('iterations', 'i4')])
+        gain = None
+        for i, frequency in enumerate(frequencies):
+            level, reading, iterations = self.level(frequency, gain)
+            gain = reading - level
+            results[i] = (frequency, level, reading, iterations)
+        self.results = results
+        converged = np.abs(results['reading'] - self.target) <= self.tolerance
+        self.calibration.update(results['frequency'][converged], (results['reading'] - results['level'])[converged])
+        self.calibration.target = self.target
+        return results
+
+    def save(self, path=None):
+        '''Saves the calibration, by default to the file it was loaded from'''
+        path = path or self.path
+        if path is None:
+            raise ValueError('No calibration file given')
+        self.calibration.save(path)
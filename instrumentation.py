@@ -0,0 +1,211 @@
+import json
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket holds anything slower
+BUCKETS = (
+    50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3,
+    0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0,
+)
+
+# Key recorded for joined batch messages, binary block uploads and commands that are not from the driver
+BATCH = 'batch'
+BLOCK = 'block'
+OTHER = 'other'
+
+
+def command_key(message):
+    '''Returns the driver key of a command, the command itself for * common commands'''
+    key = getattr(message, 'key', None)
+    if key is not None:
+        return key
+    if message.startswith('*'):
+        return message
+    return OTHER
+
+
+class Histogram:
+    '''Fixed bucket latency histogram with counts, bytes and totals for one command key'''
+    __slots__ = ('buckets', 'count', 'seconds', 'max', 'sent', 'received')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.sent = 0
+        self.received = 0
+
+    def add(self, seconds, sent=0, received=0):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.sent += sent
+        self.received += received
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        '''Returns the upper bound of the bucket holding the q-th percentile, q from 0 to 100'''
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        total = 0
+        for bound, count in zip(BUCKETS + (self.max,), self.buckets):
+            total += count
+            if total >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count, 'seconds': self.seconds,
+            'mean': self.seconds / self.count if self.count else None,
+            'p50': self.percentile(50), 'p95': self.percentile(95), 'max': self.max,
+            'bytes_sent': self.sent, 'bytes_received': self.received,
+        }
+
+
+class Recorder:
+    '''Records the latency and bytes of every bus call of the instruments it is attached to.
+
+    Calls are counted into a Histogram per (resource string, command key)
+    and passed as event dicts to each exporter, any callable such as
+    JsonLinesExporter.  Attach one with BaseInstrument.record(), detached
+    instruments pay a single attribute check per bus call.
+
+    Example:
+        recorder = Recorder(JsonLinesExporter('bus.jsonl'))
+        sa.record(recorder)
+        sweep(sa)
+        print(recorder.format_summary())
+    '''
+    def __init__(self, *exporters):
+        self.exporters = list(exporters)
+        self.histograms = {}
+
+    def record(self, resource_string, operation, key, seconds, sent=0, received=0):
+        histogram = self.histograms.get((resource_string, key))
+        if histogram is None:
+            histogram = self.histograms[(resource_string, key)] = Histogram()
+        histogram.add(seconds, sent, received)
+        if self.exporters:
+            event = {
+                'time': time.time(), 'resource': resource_string, 'operation': operation, 'key': key,
+                'seconds': seconds, 'bytes_sent': sent, 'bytes_received': received,
+            }
+            for exporter in self.exporters:
+                exporter(event)
+
+    def summary(self, resource_string=None):
+        '''Returns {resource string: {command key: statistics}}, optionally for one resource'''
+        summary = {}
+        for (resource, key), histogram in self.histograms.items():
+            if resource_string is None or resource == resource_string:
+                summary.setdefault(resource, {})[key] = histogram.summary()
+        return summary
+
+    def format_summary(self):
+        '''Returns the summary as a text table, slowest command keys first'''
+        lines = [f'{"resource":<22} {"key":<28} {"count":>7} {"total ms":>10} {"p50 ms":>8} {"p95 ms":>8} {"sent":>9} {"received":>10}']
+        rows = sorted(self.histograms.items(), key=lambda item: -item[1].seconds)
+        for (resource, key), h in rows:
+            lines.append(
+                f'{resource:<22} {key:<28} {h.count:>7} {h.seconds * 1000:>10.1f} {h.percentile(50) * 1000:>8.2f} '
+                f'{h.percentile(95) * 1000:>8.2f} {h.sent:>9} {h.received:>10}')
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.histograms.clear()
+
+    def close(self):
+        '''Closes exporters that hold files'''
+        for exporter in self.exporters:
+            if hasattr(exporter, 'close'):
+                exporter.close()
+
+
+class JsonLinesExporter:
+    '''Writes each event as one line of JSON to a file'''
+    def __init__(self, path, flush=False):
+        self._file = open(path, 'a')
+        self.flush = flush
+
+    def __call__(self, event):
+        self._file.write(json.dumps(event) + '\n')
+        if self.flush:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class InstrumentedResource:
+    '''Times the calls made on a pyvisa resource and reports them to a Recorder.
+
+    Reads are recorded under the key of the command written before them,
+    so a trace transfer shows up as the trace.values write and its reads.
+    Other attributes pass through to the resource.
+    '''
+    __slots__ = ('resource', 'recorder', 'resource_string', 'last_key')
+
+    def __init__(self, resource, recorder, resource_string):
+        object.__setattr__(self, 'resource', resource)
+        object.__setattr__(self, 'recorder', recorder)
+        object.__setattr__(self, 'resource_string', resource_string)
+        object.__setattr__(self, 'last_key', OTHER)
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resource, name, value)
+
+    def _write_key(self, message):
+        key = command_key(message)
+        object.__setattr__(self, 'last_key', key)
+        return key
+
+    def write(self, message, *args, **kwargs):
+        key = self._write_key(message)
+        start = time.perf_counter()
+        result = self.resource.write(message, *args, **kwargs)
+        self.recorder.record(self.resource_string, 'write', key, time.perf_counter() - start, sent=len(message))
+        return result
+
+    def query(self, message, *args, **kwargs):
+        key = self._write_key(message)
+        start = time.perf_counter()
+        response = self.resource.query(message, *args, **kwargs)
+        self.recorder.record(self.resource_string, 'query', key, time.perf_counter() - start, len(message), len(response))
+        return response
+
+    def query_binary_values(self, message, *args, **kwargs):
+        key = self._write_key(message)
+        start = time.perf_counter()
+        values = self.resource.query_binary_values(message, *args, **kwargs)
+        received = getattr(values, 'nbytes', None) or 4 * len(values)
+        self.recorder.record(self.resource_string, 'query', key, time.perf_counter() - start, len(message), received)
+        return values
+
+    def write_raw(self, message):
+        object.__setattr__(self, 'last_key', BLOCK)
+        start = time.perf_counter()
+        result = self.resource.write_raw(message)
+        self.recorder.record(self.resource_string, 'write', BLOCK, time.perf_counter() - start, sent=len(message))
+        return result
+
+    def _read(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        data = method(*args, **kwargs)
+        self.recorder.record(self.resource_string, 'read', self.last_key, time.perf_counter() - start, received=len(data))
+        return data
+
+    def read(self, *args, **kwargs):
+        return self._read(self.resource.read, *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._read(self.resource.read_raw, *args, **kwargs)
+
+    def read_bytes(self, *args, **kwargs):
+        return self._read(self.resource.read_bytes, *args, **kwargs)
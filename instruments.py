@@ -2,50 +2,344 @@ import logging
 from pathlib import Path
 import time
 import glob
+from concurrent.futures import Future
+from contextlib import contextmanager
 
-import numpy as np
-import pandas as pd
-from ruamel.yaml import YAML
-import visa
+from pyemi.commands import compile_driver, validate, CommandString, DriverError
+from pyemi.instrumentation import InstrumentedResource, BATCH
+from pyemi.lazy import LazyModule
+from pyemi.motion import MotionMixin, parse_float
+from pyemi.resources import pool
+from pyemi.transfer import read_binary_block, read_block_header, read_block_data, write_binary_block, parse_ascii
+
+# Imported on first use so control scripts that never read a trace start quickly
+np = LazyModule('numpy', globals(), 'np')
+pd = LazyModule('pandas', globals(), 'pd')
+visa = LazyModule('pyvisa', globals(), 'visa')
+
+# Event status register operation complete bit and status byte event summary bit
+ESR_OPC = 1
+STB_ESB = 32
+
+
+FREQUENCY_UNITS = {'hz': 1, 'khz': 1e3, 'mhz': 1e6, 'ghz': 1e9}
+
+
+def _to_hz(val):
+    '''Converts a (value, unit) setter argument to Hz, None if it can't be'''
+    if type(val) is tuple and len(val) == 2 and str(val[1]).lower() in FREQUENCY_UNITS:
+        # Mirrors the %d truncation in the driver commands
+        return int(val[0]) * int(FREQUENCY_UNITS[str(val[1]).lower()])
+    elif isinstance(val, (int, float)):
+        return int(val)
+    return None
+
+
+def wait_all(instruments, timeout=None, interval=0.005, max_interval=0.5, arm=True):
+    '''Waits in one thread until operations on every instrument complete.
+
+    Each instrument is armed with arm_complete() and then polled with
+    operation_complete(), doubling the interval between rounds up to
+    max_interval so short operations return quickly and long ones cost
+    little bus time.  Raises TimeoutError after timeout seconds.
+    '''
+    pending = list(instruments)
+    if arm:
+        for instrument in pending:
+            instrument.arm_complete()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        pending = [instrument for instrument in pending if not instrument.operation_complete()]
+        if not pending:
+            return
+        if deadline is not None and time.monotonic() + interval > deadline:
+            names = ', '.join(instrument.resource_string for instrument in pending)
+            raise TimeoutError(f'{names} did not complete within {timeout} s')
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def _parse_int(response):
+    '''Parses integer responses that may be sent in exponent notation, e.g. 1.0E+06'''
+    return int(float(response))
+
+
+def _parse_opc(response):
+    '''Parses controller OPC responses, e.g. 1OK'''
+    return int(response.strip('\n').strip('OK'))
+
+
+def _root(command):
+    '''Prefixes a command with : so it is parsed from the root when joined after another'''
+    if command.startswith((':', '*')):
+        return command
+    return ':' + command
+
+
+def _setting_values(setter, arity, response):
+    '''Converts a get response into the values of its set command, None if it can't be'''
+    response = response.strip()
+    conversions = setter.conversions[arity:]
+    values = []
+    for i, conversion in enumerate(conversions):
+        if conversion in 'diuoxXeEfFgG':
+            number = parse_float(response)
+            if number is None:
+                return None
+            values.append(int(number) if conversion in 'diuoxX' else number)
+        elif i and conversions[i - 1] in 'diuoxXeEfFgG':
+            # A unit after a number, responses are in base units such as Hz
+            values.append('Hz')
+        else:
+            values.append(response)
+    return tuple(values)
+
+
+def _normalize_units(units):
+    '''Normalizes amplitude units, e.g. DBUV -> dBuV'''
+    return units.lower().strip('\n').replace('b', 'B').replace('v', 'V')
+
+
+class TraceResult:
+    '''One sweep of a trace, float32 amplitudes with the axis kept as start, stop and points.
+
+    The frequency axis and the pandas DataFrame are only built when first
+    asked for, and then kept.
+    '''
+    __slots__ = ('amplitudes', 'start', 'stop', 'units', 'trace', '_frequencies', '_dataframe')
+
+    def __init__(self, amplitudes, start, stop, units=None, trace=None):
+        self.amplitudes = amplitudes
+        self.start = start
+        self.stop = stop
+        self.units = units
+        self.trace = trace
+        self._frequencies = None
+        self._dataframe = None
+
+    def __repr__(self):
+        return f'TraceResult({self.points} points, {self.start} to {self.stop} Hz, {self.units})'
+
+    def __len__(self):
+        return self.amplitudes.size
+
+    def __array__(self, dtype=None, copy=None):
+        return self.amplitudes if dtype is None else self.amplitudes.astype(dtype)
+
+    @property
+    def points(self):
+        return self.amplitudes.size
+
+    @property
+    def frequencies(self):
+        '''Frequency of each point in Hz'''
+        if self._frequencies is None:
+            self._frequencies = np.linspace(self.start, self.stop, self.points)
+        return self._frequencies
+
+    def to_pandas(self):
+        '''Returns a DataFrame of Frequency (Hz) and Amplitude (units) columns'''
+        if self._dataframe is None:
+            self._dataframe = pd.DataFrame(data={'Frequency (Hz)': self.frequencies, f'Amplitude ({self.units})': self.amplitudes})
+        return self._dataframe
 
 
 class BaseInstrument:
     driver_folder = Path(__file__).parent.absolute() / Path('drivers')
-
-    def __init__(self, resource=None, driver=None, log_level=logging.CRITICAL, **kwargs):
+    # Number of values each driver command is formatted with, checked when the driver loads
+    command_arity = {}
+    compiled = {}
+    # None picks service requests or polling from the interface, see srq_supported
+    use_srq = None
+    # Recorder that times every bus call, see record()
+    recorder = None
+    # Settings left out of snapshot(), e.g. ones derived from others or that move hardware
+    snapshot_exclude = ()
+
+    def __init__(self, resource=None, driver=None, log_level=logging.CRITICAL, cache=False, **kwargs):
         if kwargs:
             for key, value in kwargs.items():
-                self.interface = key.upper()
+                board = key.upper()
                 self.id = value
-            self.resource_string = f'{self.interface}::{self.id}::INSTR'
+            self.resource_string = f'{board}::{self.id}::INSTR'
         else:
             self.resource_string = resource.upper()
+        # Without the board number, e.g. GPIB for GPIB0
+        self.interface = self.resource_string.split('::')[0].rstrip('0123456789')
         
         FORMAT = '[%(levelname)s]%(asctime)s - %(message)s'
         logging.basicConfig(level=log_level, format=FORMAT)
         logging.info(f'Resource string: {self.resource_string}')
 
-        self.rm = visa.ResourceManager()
-        self.resource = self.rm.open_resource(self.resource_string)
+        # Sessions come from the shared pool and open on first I/O
+        self.pool = pool
+
+        # Opt-in cache of instrument settings, filled by property getters and
+        # kept in sync by the matching setters
+        self.cache_enabled = cache
+        self._cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Commands queued by batch(), None outside of a batch
+        self._batch = None
+
+        # Session that service requests are enabled on, see arm_complete()
+        self._srq_resource = None
+
+        # Recording wrapper around the current session, see record()
+        self._instrumented = None
+
+        # Settings as of the last snapshot() or restore(), cleared by any write
+        self._known = None
 
         if driver:
             self.load_driver(driver)
     
     def load_driver(self, driver_file):
-        yaml=YAML(typ='safe')
         doc = self.driver_folder / Path(driver_file)
         if doc.exists():
             logging.info(f'Driver file: {doc}')
-            self.commands = yaml.load(doc)
+            self.commands, self.compiled = compile_driver(doc)
+            validate(self.compiled, self.command_arity, doc.name)
             if 'write_termination' in self.commands:
-                self.resource.write_termination = self.commands['write_termination']
+                self.pool.configure(self.resource_string, write_termination=self.commands['write_termination'])
             if 'query_delay' in self.commands:
-                self.resource.query_delay = float(self.commands['query_delay'])
+                self.pool.configure(self.resource_string, query_delay=float(self.commands['query_delay']))
         else:
             logging.warning(f'Driver file does not exist: {doc}')
 
-    def list_available_drivers(self):
-        drivers = glob.glob(str(self.driver_folder / Path('*.yaml')))
+    def command(self, key, *args):
+        '''Returns the driver command for key formatted with args, e.g. command('frequency.start.set', 1, 'MHz')'''
+        command = self.compiled.get(key)
+        if command is None:
+            raise DriverError(f'{key} is not defined in the driver')
+        return command(*args)
+
+    @property
+    def resource(self):
+        '''The pyvisa resource, opened on first use and shared with instruments at the same address'''
+        resource = self.pool.get(self.resource_string)
+        if self.recorder is None:
+            return resource
+        instrumented = self._instrumented
+        if instrumented is None or instrumented.resource is not resource or instrumented.recorder is not self.recorder:
+            instrumented = self._instrumented = InstrumentedResource(resource, self.recorder, self.resource_string)
+        return instrumented
+
+    def record(self, recorder):
+        '''Times every bus call of this instrument into recorder, None stops recording'''
+        self.recorder = recorder
+        self._instrumented = None
+
+    @property
+    def rm(self):
+        return self.pool.resource_manager
+
+    def close(self):
+        '''Closes the shared session, it reopens on the next I/O'''
+        self.pool.close(self.resource_string)
+
+    def write(self, command):
+        '''Writes a command, queueing it when inside a batch'''
+        self._known = None
+        if self._batch is not None:
+            self._batch.append((command, None, None))
+        else:
+            self.resource.write(command)
+
+    def query(self, command, parse=None):
+        '''Queries the instrument and returns the response, optionally parsed.
+
+        Inside a batch the query is queued and a Future is returned that
+        resolves to the response when the batch is sent.
+        '''
+        if self._batch is not None:
+            future = Future()
+            self._batch.append((command, future, parse))
+            return future
+        with self.pool.in_use(self.resource_string):
+            response = self.resource.query(command)
+        return parse(response) if parse else response
+
+    @contextmanager
+    def batch(self, opc=False, max_length=None):
+        '''Queues commands and sends them joined with ; in as few messages as possible.
+
+        The driver's max_message_length limits the length of each message,
+        drivers without it send one command per message.  With opc=True a
+        single *OPC? is appended so the batch returns once all commands have
+        completed.  Queries return Futures resolved when the batch is sent.
+        '''
+        if self._batch is not None:
+            # Nested batches join the outer one
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+            queued = self._batch
+            self._batch = None
+            self._send_batch(queued, opc, max_length)
+        finally:
+            if self._batch is not None:
+                for command, future, parse in self._batch:
+                    if future is not None:
+                        future.cancel()
+                self._batch = None
+
+    def _send_batch(self, queued, opc, max_length):
+        if max_length is None:
+            max_length = int(self.commands.get('max_message_length', 0))
+        if opc:
+            queued = queued + [('*OPC?', Future(), int)]
+
+        messages = []
+        for command, future, parse in queued:
+            if messages and max_length:
+                joined = messages[-1][0] + ';' + _root(command)
+                if len(joined) <= max_length:
+                    messages[-1][0] = CommandString(joined, BATCH)
+                    messages[-1][1].append((command, future, parse))
+                    continue
+            messages.append([command, [(command, future, parse)]])
+
+        with self.pool.in_use(self.resource_string):
+            self._send_messages(queued, messages)
+
+    def _send_messages(self, queued, messages):
+        for message, entries in messages:
+            futures = [(future, parse) for command, future, parse in entries if future is not None]
+            try:
+                if not futures:
+                    self.resource.write(message)
+                    continue
+                response = self.resource.query(message).strip()
+                responses = [response] if len(futures) == 1 else response.split(';')
+                if len(responses) != len(futures):
+                    raise ValueError(f'Expected {len(futures)} responses to {message}, got {len(responses)}')
+            except Exception as e:
+                for command, future, parse in queued:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                raise
+            error = None
+            for (future, parse), response in zip(futures, responses):
+                try:
+                    future.set_result(parse(response) if parse else response)
+                except Exception as e:
+                    future.set_exception(e)
+                    error = error or e
+            if error is not None:
+                # Later messages are not sent, their queries fail with the first parse error
+                for command, future, parse in queued:
+                    if future is not None and not future.done():
+                        future.set_exception(error)
+                raise error
+
+    @classmethod
+    def list_available_drivers(cls):
+        drivers = glob.glob(str(cls.driver_folder / Path('*.yaml')))
         return [Path(f).name for f in drivers]
 
     def __str__(self):
@@ -63,119 +357,307 @@ class BaseInstrument:
 
     def reset(self):
         '''Resets instrument'''
-        self.resource.write('*RST')
+        self.write('*RST')
+        self.invalidate()
+
+    def invalidate(self, *keys):
+        '''Clears cached settings, all of them if no keys are given'''
+        if keys:
+            for key in keys:
+                self._cache.pop(key, None)
+        else:
+            self._cache.clear()
+
+    def cache_info(self):
+        '''Returns settings cache hits, misses and current size'''
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self._cache)}
+
+    def _cached(self, key, getter):
+        '''Returns the cached value for key, calling getter on a miss'''
+        if not self.cache_enabled:
+            return getter()
+        if key in self._cache:
+            self.cache_hits += 1
+            if self._batch is not None:
+                # Queries inside a batch always return Futures
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+            return self._cache[key]
+        self.cache_misses += 1
+        value = getter()
+        if isinstance(value, Future):
+            # Queried inside a batch, cache the value once the batch is sent
+            def store(future):
+                if not future.cancelled() and future.exception() is None:
+                    self._cache[key] = future.result()
+            value.add_done_callback(store)
+        else:
+            self._cache[key] = value
+        return value
+
+    def _store(self, key, value):
+        '''Records a value written to the instrument, None drops the key'''
+        if not self.cache_enabled:
+            return
+        if value is None:
+            self._cache.pop(key, None)
+        else:
+            self._cache[key] = value
+
+    def _snapshot_args(self, base, arity):
+        '''Returns (name, args) for each instance of a setting whose get command takes arity values'''
+        return [(base, ())] if arity == 0 else []
+
+    def _settings(self):
+        settings = []
+        for key, getter in self.compiled.items():
+            base = key[:-4]
+            setter = self.compiled.get(base + '.set')
+            # Setters without values of their own are actions, e.g. starting a scan
+            if not key.endswith('.get') or setter is None or setter.arity <= getter.arity or base in self.snapshot_exclude:
+                continue
+            for name, args in self._snapshot_args(base, getter.arity):
+                settings.append((name, base, args))
+        return settings
+
+    def snapshot(self):
+        '''Reads every driver setting that can be written back in one batch and returns them.
+
+        The snapshot maps setting names, e.g. frequency.start or
+        trace.detector.1, to the values its set command is formatted with.
+        '''
+        settings = self._settings()
+        with self.batch():
+            responses = [self.query(self.command(base + '.get', *args)) for name, base, args in settings]
+        snapshot = {}
+        for (name, base, args), response in zip(settings, responses):
+            values = _setting_values(self.compiled[base + '.set'], len(args), response.result())
+            if values is not None:
+                snapshot[name] = values
+        self._known = dict(snapshot)
+        return snapshot
+
+    def restore(self, snapshot):
+        '''Writes the settings of a snapshot that differ from the instrument's, in one batch.
+
+        The instrument's settings are read with snapshot() unless they are
+        known from a snapshot() or restore() with no writes since.  Returns
+        the names of the settings written.
+        '''
+        current = self._known if self._known is not None else self.snapshot()
+        settings = {name: (base, args) for name, base, args in self._settings()}
+        changed = [name for name, values in snapshot.items() if name in settings and tuple(current.get(name, ())) != tuple(values)]
+        if changed:
+            with self.batch():
+                for name in changed:
+                    base, args = settings[name]
+                    self.write(self.command(base + '.set', *args, *snapshot[name]))
+            self.invalidate()
+        self._known = dict(current, **{name: tuple(snapshot[name]) for name in changed})
+        return changed
 
     def opc(self):
         '''Returns 1 when command is completed, 0 otherwise'''
-        return int(self.resource.query('*OPC?'))
+        return self.query('*OPC?', int)
+
+    def ese(self, val):
+        '''Event status enable sets the bits of the event status registers'''
+        self.write(f'*ESE {val}')
+
+    def esr(self):
+        '''Queries and clears the contents of the event status register'''
+        return self.query('*ESR?', _parse_int)
+
+    @property
+    def srq_supported(self):
+        '''True when completion can be signalled with a VISA service request event'''
+        if self.use_srq is not None:
+            return self.use_srq
+        return self.interface in ('GPIB', 'USB', 'TCPIP') and self.resource_string.endswith('::INSTR')
+
+    def arm_complete(self):
+        '''Sets the OPC bit of the event status register once pending operations finish.
+
+        Stale status is cleared by reading the register in the same message.
+        With service requests the OPC bit is routed to SRQ through *ESE/*SRE.
+        '''
+        resource = self.resource
+        if self.srq_supported and self._srq_resource is not resource:
+            self.write(f'*ESE {ESR_OPC};*SRE {STB_ESB}')
+            resource.enable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+            self._srq_resource = resource
+        self.query('*ESR?;*OPC')
+
+    def operation_complete(self):
+        '''Returns True once the operation armed by arm_complete() has finished, without blocking'''
+        if self._srq_resource is not None and self._srq_resource is self.resource:
+            try:
+                self._srq_resource.wait_on_event(visa.constants.EventType.service_request, 0)
+            except visa.errors.VisaIOError:
+                return False
+            self._srq_resource.read_stb()
+        return bool(self.esr() & ESR_OPC)
+
+    def wait_complete(self, timeout=None):
+        '''Blocks until pending operations complete or timeout seconds pass.
+
+        Waits on the service request event where the interface supports it,
+        otherwise polls with exponential backoff, see wait_all().
+        '''
+        self.arm_complete()
+        if self._srq_resource is None:
+            return wait_all([self], timeout=timeout, arm=False)
+
+        with self.pool.in_use(self.resource_string):
+            self._wait_srq(timeout)
+
+    def _wait_srq(self, timeout):
+        resource = self._srq_resource
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = visa.constants.VI_TMO_INFINITE if deadline is None else max(int((deadline - time.monotonic()) * 1000), 0)
+            try:
+                resource.wait_on_event(visa.constants.EventType.service_request, remaining)
+            except visa.errors.VisaIOError:
+                raise TimeoutError(f'{self.resource_string} did not complete within {timeout} s')
+            resource.read_stb()
+            if self.esr() & ESR_OPC:
+                return
 
 
 class SpectrumAnalyzer(BaseInstrument):
+    command_arity = {
+        'rbw.set': 2, 'vbw.set': 2, 'amplitude.units.set': 1, 'mode': 1, 'input': 1, 'display': 1,
+        'frequency.start.set': 2, 'frequency.stop.set': 2, 'frequency.center.set': 2, 'frequency.span.set': 2,
+        'sweep.points.set': 1, 'sweep.count.set': 1, 'sweep.time': 2, 'format.binary': 2,
+        'trace.mode.set': 2, 'trace.mode.get': 1, 'trace.detector.set': 2, 'trace.detector.get': 1,
+        'trace.values': 1, 'trace.frequencies': 1,
+        'marker.state': 2, 'marker.max': 1, 'marker.min': 1, 'marker.center': 1, 'marker.amplitude': 1,
+        'marker.frequency.set': 3, 'marker.frequency.get': 1,
+        'scan.frequency.start': 3, 'scan.frequency.step': 3, 'scan.frequency.stop': 3, 'scan.rbw': 3,
+        'scan.time': 3, 'scan.bars': 2, 'scan.input': 2, 'scan.name': 2, 'scan.ranges': 2,
+        'scan.attenuation.on': 1, 'scan.attenuation.off': 1, 'scan.attenuation.value': 2,
+        'scan.preamp.auto': 2, 'scan.preamp.state': 2, 'scan.lna.auto': 2, 'scan.lna.state': 2,
+        'scan.tdo.time': 2, 'scan.tdo.mode': 1, 'scan.mode': 1,
+    }
+    # Transducer corrections added to traces by Trace.result() and dataframe(), see pyemi.corrections
+    corrections = None
+    # Center and span follow from start and stop, the peak hold bargraph is a reading
+    snapshot_exclude = ('frequency.center', 'frequency.span', 'bargraph.max')
+    # Traces whose mode and detector are included in snapshot()
+    snapshot_traces = (1, 2, 3)
+
     def __init__(self, **kwargs):
         return super().__init__(**kwargs)
 
-    def ese(self, val):
-        '''Event status enable sets the bits of the event status registers'''
-        self.resource.write(f'*ESE {val}')
-
-    def esr(self):
-        '''Queries the contents of the event status register'''
-        self.resource.query('*ESR?')
+    def _snapshot_args(self, base, arity):
+        if base.startswith('trace.') and arity == 1:
+            return [(f'{base}.{t}', (t,)) for t in self.snapshot_traces]
+        return super()._snapshot_args(base, arity)
 
     @property
     def rbw(self):
-        command = self.commands['rbw']['get']
-        return int(self.resource.query(command))
+        command = self.command('rbw.get')
+        return self._cached('rbw', lambda: self.query(command, _parse_int))
 
     @rbw.setter
     def rbw(self, val):
-        command = self.commands['rbw']['set'] % val
-        self.resource.write(command)
+        command = self.command('rbw.set', val)
+        self.write(command)
+        self._store('rbw', _to_hz(val))
 
     @property
     def vbw(self):
-        command = self.commands['vbw']['get']
-        return int(self.resource.query(command))
+        command = self.command('vbw.get')
+        return self._cached('vbw', lambda: self.query(command, _parse_int))
 
     @vbw.setter
     def vbw(self, val):
-        command = self.commands['vbw']['set'] % val
-        self.resource.write(command)
+        command = self.command('vbw.set', val)
+        self.write(command)
+        self._store('vbw', _to_hz(val))
 
     @property
     def amplitude_units(self):
-        command = self.commands['amplitude']['units']['get']
-        units = self.resource.query(command)
-        units = units.lower().strip('\n').replace('b', 'B').replace('v', 'V')
-        return units
+        command = self.command('amplitude.units.get')
+        return self._cached('amplitude.units', lambda: self.query(command, _normalize_units))
 
     @amplitude_units.setter
     def amplitude_units(self, val):
-        command = self.commands['amplitude']['units']['set'] % val
-        self.resource.write(command)
+        command = self.command('amplitude.units.set', val)
+        self.write(command)
+        self._store('amplitude.units', _normalize_units(val))
 
     @property
     def start_frequency(self):
-        command = self.commands['frequency']['start']['get']
-        return int(self.resource.query(command))
+        command = self.command('frequency.start.get')
+        return self._cached('frequency.start', lambda: self.query(command, _parse_int))
 
     @start_frequency.setter
     def start_frequency(self, val):
-        command = self.commands['frequency']['start']['set'] % val
-        self.resource.write(command)
+        command = self.command('frequency.start.set', val)
+        self.write(command)
+        self.invalidate('frequency.center', 'frequency.span')
+        self._store('frequency.start', _to_hz(val))
 
     @property
     def stop_frequency(self):
-        command = self.commands['frequency']['stop']['get']
-        return int(self.resource.query(command))
+        command = self.command('frequency.stop.get')
+        return self._cached('frequency.stop', lambda: self.query(command, _parse_int))
 
     @stop_frequency.setter
     def stop_frequency(self, val):
-        command = self.commands['frequency']['stop']['set'] % val
-        self.resource.write(command)
+        command = self.command('frequency.stop.set', val)
+        self.write(command)
+        self.invalidate('frequency.center', 'frequency.span')
+        self._store('frequency.stop', _to_hz(val))
 
     @property
     def center_frequency(self):
-        command = self.commands['frequency']['center']['get']
-        return self.resource.query(command)
+        command = self.command('frequency.center.get')
+        return self._cached('frequency.center', lambda: self.query(command))
 
     @center_frequency.setter
     def center_frequency(self, val):
-        command = self.commands['frequency']['center']['set'] % val
-        self.resource.write(command)
+        command = self.command('frequency.center.set', val)
+        self.write(command)
+        self.invalidate('frequency.start', 'frequency.stop', 'frequency.center')
 
     @property
     def span_frequency(self):
-        command = self.commands['frequency']['span']['get']
-        return self.resource.query(command)
+        command = self.command('frequency.span.get')
+        return self._cached('frequency.span', lambda: self.query(command))
 
     @span_frequency.setter
     def span_frequency(self, val):
-        command = self.commands['frequency']['span']['set'] % val
-        self.resource.write(command)
+        command = self.command('frequency.span.set', val)
+        self.write(command)
+        self.invalidate('frequency.start', 'frequency.stop', 'frequency.span')
 
     @property
     def sweep_mode(self):
-        command = self.commands['sweep']['mode']['get']
-        return self.resource.query(command)
+        command = self.command('sweep.mode.get')
+        return self.query(command)
 
     @sweep_mode.setter
     def sweep_mode(self, val):
         if val.lower() == 'continuous' or val.lower() == 'on' or val == 1:
-            command = self.commands['sweep']['mode']['continuous']['set']
+            command = self.command('sweep.mode.continuous')
         else:
-            command = self.commands['sweep']['mode']['single']['set']
-        return self.resource.write(command)
+            command = self.command('sweep.mode.single')
+        return self.write(command)
 
     @property
     def sweep_points(self):
-        command = self.commands['sweep']['points']['get']
-        return self.resource.query(command)
+        command = self.command('sweep.points.get')
+        return self._cached('sweep.points', lambda: self.query(command, _parse_int))
 
     @sweep_points.setter
     def sweep_points(self, val):
-        command = self.commands['sweep']['points']['set'] % val
-        return self.resource.query(command)
+        command = self.command('sweep.points.set', val)
+        self.write(command)
+        self._store('sweep.points', int(val))
 
     @property
     def mode(self):
@@ -183,14 +665,15 @@ class SpectrumAnalyzer(BaseInstrument):
 
     @mode.setter
     def mode(self, val):
-        command = self.commands['mode']
         if 'spectrum' in val.lower() or 'san' in val.lower() or 'analyzer' in val.lower():
-            command = command % 'SAN'
+            command = self.command('mode', 'SAN')
             self._mode = 'SAN'
-        elif 'receiver' in val.lower() or 'emi' in val.lower():
-            command = command % 'REC'
+        elif 'receiver' in val.lower() or 'emi' in val.lower() or val.lower() == 'rec':
+            command = self.command('mode', 'REC')
             self._mode = 'REC'
-        self.resource.write(command)
+        self.write(command)
+        # Switching applications changes every other setting
+        self.invalidate()
 
     @property
     def rf_input(self):
@@ -198,22 +681,27 @@ class SpectrumAnalyzer(BaseInstrument):
 
     @rf_input.setter
     def rf_input(self, val):
-        command = self.commands['input'] % val
+        command = self.command('input', val)
         self._rf_input = val
-        self.resource.write(command)
+        self.write(command)
     
     @property
     def format(self):
-        command = self.commands['format']['get']
-        return self.resource.query()
+        command = self.command('format.get')
+        return self.query(command)
 
     @format.setter
     def format(self, val):
         if type(val) is tuple:
-            command = self.commands['format']['binary'] % val
+            command = self.command('format.binary', val)
         elif 'asc' in val.lower():
-            command = self.commands['format']['ascii']
-        self.resource.write(command)
+            command = self.command('format.ascii')
+        # The command sent is cached rather than the query response, which is formatted differently
+        if self.cache_enabled and self._cache.get('format') == command:
+            self.cache_hits += 1
+            return
+        self.write(command)
+        self._store('format', command)
 
     @property
     def display(self):
@@ -221,9 +709,15 @@ class SpectrumAnalyzer(BaseInstrument):
 
     @display.setter
     def display(self, val):
-        command = self.commands['display']
-        command.format(val)
-        self.resource.write(command)
+        command = self.command('display', val)
+        self._display = val
+        self.write(command)
+
+    @property
+    def binary_transfer(self):
+        '''True when trace data can be read as binary blocks on this interface'''
+        # Serial ports terminate reads on line feeds that can appear in binary data
+        return self.interface != 'ASRL' and 'format.binary' in self.compiled
 
     def Trace(self, t):
         return self._Trace(t, self)
@@ -235,44 +729,228 @@ class SpectrumAnalyzer(BaseInstrument):
 
         @property
         def mode(self):
-            command = self.sa.commands['trace']['mode']['get'] % self._trace
-            return self.sa.resource.query(command)
+            command = self.sa.command('trace.mode.get', self._trace)
+            return self.sa.query(command)
 
         @mode.setter
         def mode(self, val):
-            command = self.sa.commands['trace']['mode']['set'] % (self._trace, val)
-            self.sa.resource.write(command)
+            command = self.sa.command('trace.mode.set', self._trace, val)
+            self.sa.write(command)
 
         @property
         def detector(self):
-            command = self.sa.commands['trace']['detector']['get'] % self._trace
-            return self.sa.resource.query(command)
+            command = self.sa.command('trace.detector.get', self._trace)
+            return self.sa.query(command)
 
         @detector.setter
         def detector(self, val):
-            command = self.sa.commands['trace']['detector']['set'] % (self._trace, val)
-            self.sa.resource.write(command)
-
-        def dataframe(self, delay=None):
-            ''' Returns pandas dataframe of Frequency (Hz), Amplitude ()'''
-            command = self.sa.commands['trace']['values'] % self._trace
-            pd.options.display.float_format = '{:.2f}'.format
-            if self.sa.interface.upper() == 'TCPIP':
+            command = self.sa.command('trace.detector.set', self._trace, val)
+            self.sa.write(command)
+
+        def array(self, delay=None, out=None):
+            '''Returns trace amplitudes as a float32 numpy array, read into out if given'''
+            if self.sa._batch is not None:
+                raise RuntimeError('Trace data cannot be read inside a batch')
+            command = self.sa.command('trace.values', self._trace)
+            if self.sa.binary_transfer:
                 self.sa.format = ('REAL', 32)
-                data = self.sa.resource.query_binary_values(command, delay=delay, data_points=self.sa.sweep_points)
-            elif self.sa.interface.upper() == 'GPIB':
+                self.sa.write(command)
                 if delay:
                     time.sleep(delay)
-                self.sa.format = 'ASCII'
-                data = self.sa.resource.query(command)
-                data = data.replace('\n', '001')
-                data = data.replace('001001', '001')
-                data = data.split(',')
-            frequency = np.linspace(self.sa.start_frequency, self.sa.stop_frequency, len(data))
+                return read_binary_block(self.sa.resource, np.float32, out=out)
+            if delay:
+                time.sleep(delay)
+            self.sa.format = 'ASCII'
+            return self.sa.query(command, lambda data: parse_ascii(data, np.float32, out=out))
+
+        def result(self, delay=None, out=None):
+            '''Returns the trace as a TraceResult, amplitudes read into out if given'''
+            data = self.array(delay=delay, out=out)
+            start, stop = self.sa.start_frequency, self.sa.stop_frequency
             units = self.sa.amplitude_units
-            df = pd.DataFrame(data={'Frequency (Hz)': frequency, f'Amplitude ({units})': data})
-            df[f'Amplitude ({units})'] = df[f'Amplitude ({units})'].astype(float)
-            return df
+            corrections = self.sa.corrections
+            if corrections is not None:
+                corrections.apply(data, start, stop)
+                units = corrections.units or units
+            return TraceResult(data, start, stop, units, self._trace)
+
+        def dataframe(self, delay=None):
+            ''' Returns pandas dataframe of Frequency (Hz), Amplitude ()'''
+            return self.result(delay=delay).to_pandas()
+
+    def read_traces(self, traces, delay=None, out=None):
+        '''Reads several traces in one query and returns them as rows of a float32 array.
+
+        All traces come from the same sweep.  Binary responses are read
+        block by block straight into the rows of out, or a new array sized
+        from the first block.
+        '''
+        if self._batch is not None:
+            raise RuntimeError('Trace data cannot be read inside a batch')
+        traces = list(traces)
+        message = ';'.join(_root(self.command('trace.values', t)) if i else self.command('trace.values', t) for i, t in enumerate(traces))
+        message = CommandString(message, 'trace.values')
+
+        if not self.binary_transfer:
+            self.format = 'ASCII'
+            if delay:
+                time.sleep(delay)
+            rows = self.query(message).strip().split(';')
+            if len(rows) != len(traces):
+                raise ValueError(f'Expected {len(traces)} traces, got {len(rows)}')
+            first = parse_ascii(rows[0], np.float32)
+            if out is None:
+                out = np.empty((len(traces), first.size), dtype=np.float32)
+            out[0] = first
+            for row, data in zip(out[1:], rows[1:]):
+                parse_ascii(data, np.float32, out=row)
+            return out
+
+        self.format = ('REAL', 32)
+        self.write(message)
+        if delay:
+            time.sleep(delay)
+        resource = self.resource
+        for i in range(len(traces)):
+            length = read_block_header(resource)
+            if out is None:
+                out = np.empty((len(traces), length // 4), dtype=np.float32)
+            # The byte after each block is the ; separator or the final terminator
+            read_block_data(resource, length, out[i], np.float32)
+        return out
+
+    def stream(self, trace, n_sweeps=None, buffer_size=16):
+        '''Returns an iterator that triggers single sweeps and yields the trace amplitudes'''
+        return self._Stream(self, trace, n_sweeps, buffer_size)
+
+    class _Stream:
+        '''Single sweep acquisition into a fixed size ring buffer.
+
+        Each sweep is read into the next row of buffer and yielded, rows are
+        overwritten after buffer_size sweeps so copy any you need to keep.
+        max_hold, min_hold and average accumulate over every sweep so far.
+        '''
+        def __init__(self, sa, trace, n_sweeps, buffer_size):
+            self.sa = sa
+            self.trace = sa.Trace(trace)
+            self.n_sweeps = n_sweeps
+            self.buffer_size = buffer_size
+            self.buffer = None
+            self.max_hold = None
+            self.min_hold = None
+            self.count = 0
+            self._sum = None
+
+        @property
+        def average(self):
+            if not self.count:
+                return None
+            return (self._sum / self.count).astype(np.float32)
+
+        def __iter__(self):
+            points = self.sa.sweep_points
+            self.buffer = np.empty((self.buffer_size, points), dtype=np.float32)
+            self.max_hold = np.full(points, -np.inf, dtype=np.float32)
+            self.min_hold = np.full(points, np.inf, dtype=np.float32)
+            self._sum = np.zeros(points, dtype=np.float64)
+            self.count = 0
+
+            self.sa.write(self.sa.command('sweep.mode.single'))
+            start = self.sa.command('sweep.start')
+            while self.n_sweeps is None or self.count < self.n_sweeps:
+                sweep = self.buffer[self.count % self.buffer_size]
+                self.sa.write(start)
+                self.trace.array(out=sweep)
+                np.maximum(self.max_hold, sweep, out=self.max_hold)
+                np.minimum(self.min_hold, sweep, out=self.min_hold)
+                self._sum += sweep
+                self.count += 1
+                yield sweep
+
+    def segmented_sweep(self, band_plan, trace=1, timeout=None):
+        '''Sweeps each segment of a band plan in turn and returns (frequencies, amplitudes) for the whole span.
+
+        band_plan holds dicts with start and stop in Hz and optionally rbw,
+        vbw in Hz and points, or (start, stop, rbw) tuples.  Segments without
+        points use the current sweep points.  While the analyzer sweeps one
+        segment the previous one is parsed and stitched into a single
+        preallocated array.  Where segments overlap the maximum is kept, at
+        the frequencies of the later segment.  A segment may only overlap the
+        one after it, a ValueError is raised for one that contains another.
+        '''
+        if self._batch is not None:
+            raise RuntimeError('A segmented sweep cannot run inside a batch')
+        segments = sorted(
+            (dict(s) if isinstance(s, dict) else dict(zip(('start', 'stop', 'rbw'), s)) for s in band_plan),
+            key=lambda s: s['start'])
+        default_points = None
+        for s in segments:
+            if not s.get('points'):
+                default_points = default_points or self.sweep_points
+                s['points'] = default_points
+
+        # Each segment keeps the points below the next start, the rest are merged into the next segment
+        for i, s in enumerate(segments[:-1]):
+            limit = min([segments[i + 1]['stop']] + [n['start'] for n in segments[i + 2:i + 3]])
+            if s['stop'] > limit:
+                raise ValueError(
+                    f'Segment {s["start"]} to {s["stop"]} Hz extends beyond the segment that follows it, '
+                    f'split it so segments only overlap their neighbours')
+        axes = [np.linspace(s['start'], s['stop'], s['points']) for s in segments]
+        keep = [int(np.searchsorted(f, n['start'], 'left')) for f, n in zip(axes, segments[1:])] + [axes[-1].size]
+        offsets = np.concatenate([[0], np.cumsum(keep)])
+        frequencies = np.empty(offsets[-1], dtype=np.float64)
+        amplitudes = np.empty(offsets[-1], dtype=np.float32)
+        targets = []
+        for i, f in enumerate(axes):
+            frequencies[offsets[i]:offsets[i + 1]] = f[:keep[i]]
+            if i + 1 < len(axes):
+                following = axes[i + 1][:keep[i + 1]]
+                merged = f[keep[i]:]
+                nearest = np.empty(0, dtype=np.intp)
+                if following.size:
+                    right = np.clip(np.searchsorted(following, merged), 0, following.size - 1)
+                    left = np.maximum(right - 1, 0)
+                    nearest = np.where(merged - following[left] <= following[right] - merged, left, right)
+                targets.append(offsets[i + 1] + nearest.astype(np.intp))
+
+        binary = self.binary_transfer
+        values = self.command('trace.values', trace)
+
+        def start(s):
+            with self.batch():
+                self.sweep_mode = 'single'
+                self.format = ('REAL', 32) if binary else 'ASCII'
+                self.start_frequency = (s['start'], 'Hz')
+                self.stop_frequency = (s['stop'], 'Hz')
+                self.sweep_points = s['points']
+                if s.get('rbw'):
+                    self.rbw = (s['rbw'], 'Hz')
+                if s.get('vbw'):
+                    self.vbw = (s['vbw'], 'Hz')
+                self.write(self.command('sweep.trigger'))
+
+        start(segments[0])
+        self.wait_complete(timeout)
+        pending = None
+        for i, s in enumerate(segments):
+            # Only the bus transfer holds up the next sweep
+            self.write(values)
+            raw = read_binary_block(self.resource, np.float32) if binary else self.resource.read()
+            if i + 1 < len(segments):
+                start(segments[i + 1])
+
+            data = raw if binary else parse_ascii(raw, np.float32)
+            if data.size != s['points']:
+                raise ValueError(f'Segment {s["start"]} to {s["stop"]} Hz returned {data.size} points, expected {s["points"]}')
+            amplitudes[offsets[i]:offsets[i + 1]] = data[:keep[i]]
+            if pending is not None:
+                np.maximum.at(amplitudes, *pending)
+            pending = (targets[i], data[keep[i]:]) if i + 1 < len(segments) else None
+
+            if i + 1 < len(segments):
+                self.wait_complete(timeout)
+        return frequencies, amplitudes
 
     def Marker(self, m):
         return self._Marker(m, self)
@@ -289,146 +967,248 @@ class SpectrumAnalyzer(BaseInstrument):
 
         @state.setter
         def state(self, val):
-            command = self.sa.commands['marker']['state'] % (self._marker, val)
+            command = self.sa.command('marker.state', self._marker, val)
             self._state = val
-            self.sa.resource.write(command)
+            self.sa.write(command)
 
         @property
         def frequency(self):
-            command = self.sa.commands['marker']['frequency']['get'] % self._marker
-            return self.sa.resource.query(command)
+            command = self.sa.command('marker.frequency.get', self._marker)
+            return self.sa.query(command)
 
         @frequency.setter
         def frequency(self, val):
-            command = self.sa.commands['marker']['frequency']['set'] 
             f, v = val
-            command = command % (self._marker, f, v)
-            self.sa.resource.write(command)
+            command = self.sa.command('marker.frequency.set', self._marker, f, v)
+            self.sa.write(command)
 
         @property
         def amplitude(self):
-            command = self.sa.commands['marker']['amplitude'] % self._marker
-            return float(self.sa.resource.query(command))
+            command = self.sa.command('marker.amplitude', self._marker)
+            return self.sa.query(command, float)
 
         def goto_max(self):
             '''Moves marker to maximum value'''
-            command = self.sa.commands['marker']['max'] % self._marker
-            self.sa.resource.write(command)
+            command = self.sa.command('marker.max', self._marker)
+            self.sa.write(command)
 
         def goto_min(self):
             '''Moves marker to minimum value'''
-            command = self.sa.commands['marker']['min'] % self._marker
-            self.sa.resource.write(command)
+            command = self.sa.command('marker.min', self._marker)
+            self.sa.write(command)
         
         def center(self):
             '''Centers the frequency span around the marker'''
-            command = self.sa.commands['marker']['center'] % self._marker
-            self.sa.resource.write(command)
+            command = self.sa.command('marker.center', self._marker)
+            self.sa.write(command)
 
 
 class SignalGenerator(BaseInstrument):
+    command_arity = {
+        'frequency.mode': 1, 'frequency.discrete.set': 2, 'output.set': 1, 'level.set': 1, 'unit.set': 1,
+        'format': 1, 'list.select': 1, 'list.frequency': 0, 'list.level': 0, 'list.dwell.list': 0,
+        'list.dwell.mode': 1, 'list.mode': 1, 'list.trigger.source': 1, 'list.index': 0,
+    }
+    # Polls after the list's dwell times run out before run_list() gives up waiting for its last point
+    list_grace = 3
+
     def __init__(self, **kwargs):
-        return super().__init__(**kwargs)
+        super().__init__(**kwargs)
+        # Size and total dwell of the uploaded list, see upload_list()
+        self.list_points = 0
+        self.list_duration = 0.0
+        self._list_started = None
 
     @property
     def discrete_frequency(self):
-        command = self.commands['frequency']['discrete']['get']
-        return self.resource.query(command)
+        command = self.command('frequency.discrete.get')
+        return self.query(command)
 
     @discrete_frequency.setter
     def discrete_frequency(self, val):
-        command = self.commands['frequency']['discrete']['set'] % val
-        self.resource.write(command)
+        command = self.command('frequency.discrete.set', val)
+        self.write(command)
 
     @property
     def output(self):
-        command = self.commands['output']['get']
-        return self.resource.query(command)
+        command = self.command('output.get')
+        return self.query(command)
 
     @output.setter
     def output(self, val):
-        command = self.commands['output']['set'] % val
-        self.resource.write(command)
+        command = self.command('output.set', val)
+        self.write(command)
 
     @property
     def level(self):
-        command = self.commands['level']['get']
-        return self.resource.query(command)
+        command = self.command('level.get')
+        return self.query(command)
 
     @level.setter
     def level(self, val):
-        command = self.commands['level']['set'] % val
-        self.resource.write(command)
+        command = self.command('level.set', val)
+        self.write(command)
 
     @property
     def unit(self):
-        command = self.commands['unit']['get']
-        return self.resource.query(command)
+        command = self.command('unit.get')
+        return self.query(command)
 
     @unit.setter
     def unit(self, val):
-        command = self.commands['unit']['set'] % val
-        self.resource.write(command)
-
+        command = self.command('unit.set', val)
+        self.write(command)
+
+    def upload_list(self, frequencies, levels, dwell, name='pyemi'):
+        '''Uploads a list mode table, one binary block each for frequencies in Hz, levels in dBm and dwell in s.
+
+        levels and dwell may be single values applied to every point.  The
+        generator learns the list before this returns, so running it
+        starts without delay.
+        '''
+        if self._batch is not None:
+            raise RuntimeError('List data cannot be uploaded inside a batch')
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        levels = np.broadcast_to(np.asarray(levels, dtype=np.float64), frequencies.shape)
+        dwell = np.broadcast_to(np.asarray(dwell, dtype=np.float64), frequencies.shape)
+
+        with self.batch():
+            self.write(self.command('list.select', name))
+            self.write(self.command('format', 'PACK'))
+        write_binary_block(self.resource, self.command('list.frequency'), frequencies)
+        write_binary_block(self.resource, self.command('list.level'), levels)
+        write_binary_block(self.resource, self.command('list.dwell.list'), dwell)
+        with self.batch(opc=True):
+            self.write(self.command('format', 'ASC'))
+            self.write(self.command('list.dwell.mode', 'LIST'))
+            self.write(self.command('list.learn'))
+        self.list_points = frequencies.size
+        self.list_duration = float(dwell.sum())
+
+    def start_list(self, trigger='SING'):
+        '''Switches to list mode and starts the uploaded list, returns without waiting'''
+        with self.batch():
+            self.write(self.command('list.mode', 'AUTO'))
+            self.write(self.command('list.trigger.source', trigger))
+            self.write(self.command('frequency.mode', 'LIST'))
+            self.write(self.command('list.trigger.execute'))
+        self._list_started = time.monotonic()
+
+    def list_index(self):
+        '''Returns the index of the point being output, queried from the generator'''
+        return self.query(self.command('list.index'), _parse_int)
+
+    def list_progress(self):
+        '''Returns the fraction of the list run so far, estimated from the dwell times without bus I/O'''
+        if self._list_started is None:
+            return 0.0
+        elapsed = time.monotonic() - self._list_started
+        return min(elapsed / self.list_duration, 1.0) if self.list_duration else 1.0
+
+    def run_list(self, callback=None, poll_interval=1.0, timeout=None):
+        '''Runs the uploaded list once and returns when its last point has dwelled.
+
+        The generator steps on its own dwell timing.  Every poll_interval
+        seconds the current index is read and passed to callback(index,
+        points), the only bus traffic while the list runs.  Without a
+        timeout, a list not at its last point list_grace polls after its
+        dwell times add up raises TimeoutError.
+        '''
+        self.start_list('SING')
+        if timeout is None:
+            timeout = self.list_duration + self.list_grace * poll_interval
+        deadline = self._list_started + timeout
+        index = 0
+        while True:
+            now = time.monotonic()
+            remaining = self.list_duration - (now - self._list_started)
+            if remaining <= 0:
+                # Let the generator confirm it reached the last point
+                index = self.list_index()
+                if index >= self.list_points - 1:
+                    break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{self.resource_string} list stopped at point {index} of {self.list_points}')
+            wait = min(poll_interval, remaining) if remaining > 0 else poll_interval
+            time.sleep(max(min(wait, deadline - now), 0.01))
+            if remaining > poll_interval:
+                index = self.list_index()
+                if callback:
+                    callback(index, self.list_points)
+        if callback:
+            callback(self.list_points - 1, self.list_points)
+
+    def stop_list(self):
+        '''Returns to a fixed frequency'''
+        self.write(self.command('frequency.mode', 'CW'))
+
+
+class ControllerBase(MotionMixin, BaseInstrument):
+    command_arity = {
+        'position.set': 1, 'acceleration.set': 1, 'speed.set': 1, 'cycle.set': 1, 'polarity.set': 1,
+        'position.get': 0, 'acceleration.get': 0, 'speed.get': 0, 'cycle.get': 0, 'error.get': 0,
+        'scan.set': 0, 'scan.get': 0, 'direction.get': 0, 'direction.set.stop': 0,
+    }
+    # Restoring a position would move the axis
+    snapshot_exclude = ('position',)
 
-class ControllerBase(BaseInstrument):
     def __init__(self, **kwargs):
         return super().__init__(**kwargs)
 
     @property
     def position(self):
-        command = self.commands['position']['get']
-        return self.resource.query(command)
+        command = self.command('position.get')
+        return self.query(command)
 
     @position.setter
     def position(self, val):
-        command = self.commands['position']['set'] % val
-        return self.resource.write(command)
+        command = self.command('position.set', val)
+        return self.write(command)
 
     @property
     def acceleration(self):
-        command = self.commands['acceleration']['get']
-        return self.resource.query(command)
+        command = self.command('acceleration.get')
+        return self.query(command)
 
     @acceleration.setter
     def acceleration(self, val):
-        command = self.commands['acceleration']['set'] % val
-        return self.resource.write(command)
+        command = self.command('acceleration.set', val)
+        return self.write(command)
 
     @property
     def speed(self):
-        command = self.commands['speed']['get']
-        return self.resource.query(command)
+        command = self.command('speed.get')
+        return self.query(command)
 
     @speed.setter
     def speed(self, val):
-        command = self.commands['speed']['set'] % val
-        return self.resource.write(command)
+        command = self.command('speed.set', val)
+        return self.write(command)
 
     @property
     def cycle(self):
-        command = self.commands['cycle']['get']
-        return self.resource.query(command)
+        command = self.command('cycle.get')
+        return self.query(command)
 
     @cycle.setter
     def cycle(self, val):
-        command = self.commands['cycle']['set'] % val
-        return self.resource.write(command)
+        command = self.command('cycle.set', val)
+        return self.write(command)
 
     @property
     def error(self):
-        command = self.commands['error']['get']
-        return self.resource.query(command)
+        command = self.command('error.get')
+        return self.query(command)
 
     def start_scan(self):
         '''Starts scanning from upper and lower limits based on # of cycles'''
-        command = self.commands['scan']['set']
-        self.resource.write(command)
+        command = self.command('scan.set')
+        self.write(command)
     
     def scan_progress(self):
         '''Returns scan progress'''
-        command = self.commands['scan']['get']
-        self.resource.query(command)
+        command = self.command('scan.get')
+        return self.query(command)
 
 
 class Tower(ControllerBase):
@@ -437,37 +1217,37 @@ class Tower(ControllerBase):
 
     @property
     def direction(self):
-        command = self.commands['direction']['get']
-        return self.resource.query(command)
+        command = self.command('direction.get')
+        return self.query(command)
 
     @direction.setter
     def direction(self, val):
         if val == -1 or 'd' in val.lower():
-            command = self.commands['direction']['set']['down']
+            command = self.command('direction.set.down')
         elif val == 1 or 'u' in val.lower():
-            command = self.commands['direction']['set']['up']
+            command = self.command('direction.set.up')
         elif val == 0 or 's' in val.lower():
-            command = self.commands['direction']['set']['stop']
+            command = self.command('direction.set.stop')
         else:
             logging.critical('Invalid direction, choose 1, 0, -1 or up, stop, down')
             return
-        self.resource.write(command)
+        self.write(command)
 
     @property
     def polarity(self):
-        command = self.commands['polarity']['get']
-        return self.resource.query(command)
+        command = self.command('polarity.get')
+        return self.query(command)
 
     @polarity.setter
     def polarity(self, val):
         if 'v' in val.lower():
-            command = self.commands['polarity']['set'] % 'V'
+            command = self.command('polarity.set', 'V')
         elif 'h' in val.lower():
-            command = self.commands['polarity']['set'] % 'H'
+            command = self.command('polarity.set', 'H')
         else:
             logging.critical('Invalid polarity, choose V or H')
             return
-        self.resource.write(command)
+        self.write(command)
 
 
 class Turntable(ControllerBase):
@@ -476,39 +1256,61 @@ class Turntable(ControllerBase):
 
     @property
     def direction(self):
-        command = self.commands['direction']['get']
-        return self.resource.query(command)
+        command = self.command('direction.get')
+        return self.query(command)
         
     @direction.setter
     def direction(self, val):
         if val == -1 or 'cc' in val.lower():
-            command = self.commands['direction']['set']['counterclockwise']
+            command = self.command('direction.set.counterclockwise')
         elif val == 1 or 'cw' in val.lower():
-            command = self.commands['direction']['set']['clockwise']
+            command = self.command('direction.set.clockwise')
         elif val == 0 or 's' in val.lower():
-            command = self.commands['direction']['set']['stop']
+            command = self.command('direction.set.stop')
         else:
             logging.critical('Invalid direction, choose 1, 0, -1 or cw, stop, cc')
             return
-        self.resource.write(command)
+        self.write(command)
 
 
-class DualController(BaseInstrument):
+class DualController(MotionMixin, BaseInstrument):
     '''For devices with a single interface that control both antenna mast and turntable'''
+    command_arity = {
+        'reset': 1, 'opc': 1, 'position.set': 2, 'acceleration.set': 2, 'speed.set': 2, 'cycle.set': 2,
+        'position.get': 1, 'acceleration.get': 1, 'speed.get': 1, 'cycle.get': 1, 'error.get': 1,
+        'scan.set': 1, 'scan.get': 1, 'direction.get': 1, 'direction.set.stop': 1,
+        'polarity.set': 1, 'polarity.get': 0,
+    }
+    # Restoring a position would move the axis
+    snapshot_exclude = ('position',)
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.device = 'tower'
 
     def reset(self):
-        command = self.commands['reset'] % self._device
-        self.resource.write(command)
+        command = self.command('reset', self._device)
+        self.write(command)
+        self.invalidate()
 
     def opc(self):
-        command = self.commands['opc'] % self._device
-        opc = self.resource.query(command)
-        opc = opc.strip('OK')
-        opc = opc.strip('\n')
-        return int(opc)
+        command = self.command('opc', self._device)
+        return self.query(command, _parse_opc)
+
+    def _axis(self):
+        return self.readable_device
+
+    def _snapshot_args(self, base, arity):
+        # Device settings are read for both the tower and the turntable
+        if arity == 1:
+            return [(f'{base}.{name}', (device,)) for name, device in self.commands['device'].items()]
+        return super()._snapshot_args(base, arity)
+
+    def arm_complete(self):
+        '''The controller reports completion per device through opc(), nothing to arm'''
+
+    def operation_complete(self):
+        return bool(self.opc())
 
     @property
     def device(self):
@@ -528,103 +1330,103 @@ class DualController(BaseInstrument):
 
     @property
     def position(self):
-        command = self.commands['position']['get'] % self._device
-        return self.resource.query(command)
+        command = self.command('position.get', self._device)
+        return self.query(command)
 
     @position.setter
     def position(self, val):
-        command = self.commands['position']['set'] % (self._device, val)
-        return self.resource.write(command)
+        command = self.command('position.set', self._device, val)
+        return self.write(command)
 
     @property
     def acceleration(self):
-        command = self.commands['acceleration']['get'] % self._device
-        return self.resource.query(command)
+        command = self.command('acceleration.get', self._device)
+        return self.query(command)
 
     @acceleration.setter
     def acceleration(self, val):
-        command = self.commands['acceleration']['set'] % (self._device, val)
-        return self.resource.write(command)
+        command = self.command('acceleration.set', self._device, val)
+        return self.write(command)
 
     @property
     def speed(self):
-        command = self.commands['speed']['get'] % self._device
-        return self.resource.query(command)
+        command = self.command('speed.get', self._device)
+        return self.query(command)
 
     @speed.setter
     def speed(self, val):
-        command = self.commands['speed']['set'] % (self._device, val)
-        return self.resource.write(command)
+        command = self.command('speed.set', self._device, val)
+        return self.write(command)
 
     @property
     def cycle(self):
-        command = self.commands['cycle']['get'] % self._device
-        return self.resource.query(command)
+        command = self.command('cycle.get', self._device)
+        return self.query(command)
 
     @cycle.setter
     def cycle(self, val):
-        command = self.commands['cycle']['set'] % (self._device, val)
-        return self.resource.write(command)
+        command = self.command('cycle.set', self._device, val)
+        return self.write(command)
 
     @property
     def error(self):
-        command = self.commands['error']['get'] % self._device
-        return self.resource.query(command)
+        command = self.command('error.get', self._device)
+        return self.query(command)
 
     def start_scan(self):
         '''Starts scanning from upper and lower limits based on # of cycles'''
-        command = self.commands['scan']['set'] % self._device
-        self.resource.write(command)
+        command = self.command('scan.set', self._device)
+        self.write(command)
     
     def scan_progress(self):
         '''Returns scan progress'''
-        command = self.commands['scan']['get'] % self._device
-        self.resource.query(command)
+        command = self.command('scan.get', self._device)
+        return self.query(command)
 
     @property
     def direction(self):
-        command = self.commands['direction']['get']
-        return self.resource.query(command)
+        command = self.command('direction.get', self._device)
+        return self.query(command)
 
     @direction.setter
     def direction(self, val):
         if self.readable_device == 'tower':
             if val == -1 or 'd' in val.lower():
-                command = self.commands['direction']['set']['down']
+                command = self.command('direction.set.down')
             elif val == 1 or 'u' in val.lower():
-                command = self.commands['direction']['set']['up']
+                command = self.command('direction.set.up')
             elif val == 0 or 's' in val.lower():
-                command = self.commands['direction']['set']['stop']
+                command = self.command('direction.set.stop', self._device)
             else:
                 logging.critical('Invalid direction, choose 1, 0, -1 or up, stop, down')
                 raise ValueError
         elif self.readable_device == 'turntable':
             if val == -1 or 'cc' in val.lower():
-                command = self.commands['direction']['set']['counterclockwise']
+                command = self.command('direction.set.counterclockwise')
             elif val == 1 or 'cw' in val.lower():
-                command = self.commands['direction']['set']['clockwise']
+                command = self.command('direction.set.clockwise')
             elif val == 0 or 's' in val.lower():
-                command = self.commands['direction']['set']['stop']
+                command = self.command('direction.set.stop', self._device)
             else:
                 logging.critical('Invalid direction, choose 1, 0, -1 or cw, stop, cc')
                 raise ValueError
-        self.resource.write(command)
+        self.write(command)
 
     @property
     def polarity(self):
-        command = self.commands['polarity']['get'] % self.commands['device']['tower']
-        return self.resource.query(command)
+        command = self.command('polarity.get')
+        return self.query(command)
 
     @polarity.setter
     def polarity(self, val):
         if 'v' in val.lower():
-            command = self.commands['polarity']['set'] % 'V'
+            command = self.command('polarity.set', 'V')
         elif 'h' in val.lower():
-            command = self.commands['polarity']['set'] % 'H'
+            command = self.command('polarity.set', 'H')
         else:
             logging.critical('Invalid polarity, choose V or H')
             return
-        self.resource.write(command)
+        self.write(command)
 
 if __name__ == "__main__":
     '''
@@ -645,7 +1447,7 @@ if __name__ == "__main__":
     print(controller.position)
 
     # Close connection
-    controller.resource.close()
+    controller.close()
 
     # Signal generator example
     sg = SignalGenerator(tcpip='10.0.0.11', driver='smw200a.yaml', log_level=logging.INFO)
@@ -670,7 +1472,7 @@ if __name__ == "__main__":
     print(sg.unit)
 
     # Close connection
-    sg.resource.close()
+    sg.close()
     
     # Spectrum analyzer example
     sa = SpectrumAnalyzer(tcpip='10.0.0.10', driver='esw.yaml', log_level=logging.INFO)
@@ -701,5 +1503,5 @@ if __name__ == "__main__":
     print(amp, x)
 
     # Close connection
-    sa.resource.close()
+    sa.close()
     '''
\ No newline at end of file
@@ -0,0 +1,23 @@
+import importlib
+
+
+class LazyModule:
+    '''Stands in for a module until one of its attributes is used.
+
+    On first use the module is imported and, when namespace and alias are
+    given, replaces the stand-in in that namespace so later lookups are
+    plain global lookups, e.g. np = LazyModule('numpy', globals(), 'np')
+    '''
+    def __init__(self, name, namespace=None, alias=None):
+        self._name = name
+        self._namespace = namespace
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        if self._namespace is not None:
+            self._namespace[self._alias] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f'<lazy module {self._name!r}>'
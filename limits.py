@@ -0,0 +1,116 @@
+from collections import OrderedDict
+
+from pyemi.lazy import LazyModule
+
+np = LazyModule('numpy', globals(), 'np')
+
+
+class LimitLine:
+    '''Regulatory limit made of segments that are linear in log frequency.
+
+    Segments are (start Hz, stop Hz, level) for a flat limit or
+    (start Hz, stop Hz, level at start, level at stop) for a sloped one.
+    Where two segments meet the lower level applies.  The limit on a
+    frequency grid is computed once and cached, so margins for single
+    sweeps or stacks of sweeps are whole array operations.
+
+    Example:
+        margin = CISPR32_CLASS_B_RADIATED_3M.margin(amplitudes, frequencies)
+    '''
+    cache_size = 16
+
+    def __init__(self, segments, name='', units='dBuV/m'):
+        segments = sorted((s if len(s) == 4 else (s[0], s[1], s[2], s[2])) for s in segments)
+        self.segments = segments
+        self.name = name
+        self.units = units
+        self._start, self._stop, self._level_start, self._level_stop = (np.array(c, dtype=np.float64) for c in zip(*segments))
+        self._log_start = np.log10(self._start)
+        self._log_span = np.log10(self._stop) - self._log_start
+        self._cache = OrderedDict()
+
+    def __repr__(self):
+        return f'LimitLine({self.name!r}, {len(self.segments)} segments)'
+
+    def evaluate(self, frequencies):
+        '''Returns the limit at each frequency, NaN where the limit does not apply'''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        key = (frequencies.shape, hash(frequencies.tobytes()))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        log_f = np.log10(frequencies)
+        index = np.searchsorted(self._start, frequencies, side='right') - 1
+        limit = self._level(index, log_f)
+        limit[(index < 0) | (frequencies > self._stop[np.maximum(index, 0)])] = np.nan
+
+        # A frequency at the stop of the previous segment takes the lower level
+        previous = index - 1
+        boundary = (previous >= 0) & (frequencies <= self._stop[np.maximum(previous, 0)])
+        if boundary.any():
+            limit[boundary] = np.fmin(limit[boundary], self._level(previous[boundary], log_f[boundary]))
+
+        limit.setflags(write=False)
+        self._cache[key] = limit
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return limit
+
+    def _level(self, index, log_f):
+        index = np.maximum(index, 0)
+        span = self._log_span[index]
+        fraction = np.divide(log_f - self._log_start[index], span, out=np.zeros_like(log_f), where=span > 0)
+        return self._level_start[index] + fraction * (self._level_stop[index] - self._level_start[index])
+
+    def margin(self, amplitudes, frequencies):
+        '''Returns limit minus amplitude, negative where the limit is exceeded.
+
+        amplitudes is one sweep or a stack of sweeps with frequency as the
+        last axis, NaN where the limit does not apply.
+        '''
+        return self.evaluate(frequencies) - np.asarray(amplitudes, dtype=np.float64)
+
+    def passes(self, amplitudes, frequencies, margin=0):
+        '''Returns True for each sweep with at least margin dB below the limit everywhere'''
+        return ~np.any(self.margin(amplitudes, frequencies) < margin, axis=-1)
+
+    def worst(self, amplitudes, frequencies, bands=None):
+        '''Returns (margin, frequency) of the worst point in each band for each sweep.
+
+        bands are (start, stop) pairs and default to the limit segments.
+        Both results have shape (..., bands), NaN for bands with no points.
+        '''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        margin = self.margin(amplitudes, frequencies)
+        margin = np.where(np.isnan(margin), np.inf, margin)
+        bands = bands if bands is not None else [(s[0], s[1]) for s in self.segments]
+
+        worst_margin = np.full(margin.shape[:-1] + (len(bands),), np.nan)
+        worst_frequency = np.full_like(worst_margin, np.nan)
+        for b, (start, stop) in enumerate(bands):
+            first = np.searchsorted(frequencies, start, side='left')
+            last = np.searchsorted(frequencies, stop, side='right')
+            if last <= first:
+                continue
+            index = np.argmin(margin[..., first:last], axis=-1)
+            value = np.take_along_axis(margin[..., first:last], index[..., None], axis=-1)[..., 0]
+            found = np.isfinite(value)
+            worst_margin[..., b] = np.where(found, value, np.nan)
+            worst_frequency[..., b] = np.where(found, frequencies[first + index], np.nan)
+        return worst_margin, worst_frequency
+
+
+# Class B limits at the distances they are most often measured at
+FCC_CLASS_B_RADIATED_3M = LimitLine(
+    [(30e6, 88e6, 40), (88e6, 216e6, 43.5), (216e6, 960e6, 46), (960e6, 40e9, 54)],
+    'FCC Part 15 class B radiated, 3 m', 'dBuV/m')
+CISPR32_CLASS_B_RADIATED_3M = LimitLine(
+    [(30e6, 230e6, 40), (230e6, 1e9, 47)],
+    'CISPR 32 class B radiated QP, 3 m', 'dBuV/m')
+CISPR32_CLASS_B_CONDUCTED_QP = LimitLine(
+    [(150e3, 500e3, 66, 56), (500e3, 5e6, 56), (5e6, 30e6, 60)],
+    'CISPR 32 class B AC mains QP', 'dBuV')
+CISPR32_CLASS_B_CONDUCTED_AV = LimitLine(
+    [(150e3, 500e3, 56, 46), (500e3, 5e6, 46), (5e6, 30e6, 50)],
+    'CISPR 32 class B AC mains average', 'dBuV')
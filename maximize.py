@@ -0,0 +1,235 @@
+import logging
+import math
+
+from pyemi.lazy import LazyModule
+from pyemi.peaks import window_max
+
+np = LazyModule('numpy', globals(), 'np')
+
+# Golden section ratio used to shrink search brackets
+INVERSE_PHI = (math.sqrt(5) - 1) / 2
+
+
+class Maximizer:
+    '''Finds the turntable angle, mast height and polarity of maximum emission for suspect frequencies.
+
+    A coarse grid is swept first, visiting points in serpentine order so
+    each axis travels as little as possible.  Each suspect is then refined
+    around its best grid point, angle then height, with a parabolic
+    estimate followed by golden section search.  Every sweep covers all
+    suspects, so a point already measured within the tolerances is reused
+    rather than moved to again.  turntable and tower may be the same
+    DualController.  With wrap_angle the turntable angle is searched as a
+    circle over angle_range, so a maximum near 0 degrees is bracketed from
+    both sides; set it False for turntables that cannot turn past the ends.
+
+    Example:
+        maximizer = Maximizer(sa, controller, controller, suspects=[48e6, 96e6, 125e6])
+        maximizer.coarse(angles=range(0, 360, 45), heights=(1, 2.5, 4))
+        results = maximizer.refine()
+    '''
+    def __init__(self, sa, turntable, tower, suspects, trace=1, bandwidth=None, polarities=('V', 'H'),
+                 angle_range=(0.0, 360.0), height_range=(1.0, 4.0), angle_tolerance=5.0, height_tolerance=0.1,
+                 wrap_angle=True, timeout=None):
+        self.sa = sa
+        self.turntable = turntable
+        self.tower = tower
+        self.suspects = np.asarray(suspects, dtype=np.float64)
+        self.trace = trace
+        self.bandwidth = bandwidth
+        self.polarities = [p.upper() for p in polarities]
+        self.angle_range = angle_range
+        self.height_range = height_range
+        self.angle_tolerance = angle_tolerance
+        self.height_tolerance = height_tolerance
+        self.wrap_angle = wrap_angle
+        self.timeout = timeout
+        # Every measurement, (polarity, angle, height) -> amplitude at each suspect
+        self.measurements = {}
+        self.moves = 0
+        self._polarity = None
+        self._position = None
+        self._index = None
+        self._sweep = None
+
+    def _select(self, device, controller):
+        if getattr(controller, 'readable_device', device) != device:
+            controller.device = device
+
+    def _move(self, polarity, angle, height):
+        if polarity != self._polarity:
+            self.tower.polarity = polarity
+            self._polarity = polarity
+        current = self._position or (None, None)
+        moving = []
+        for device, controller, target, now in (('tower', self.tower, height, current[1]), ('turntable', self.turntable, angle, current[0])):
+            if now is None or abs(target - now) > 1e-6:
+                self._select(device, controller)
+                controller.move_to(target, wait=False)
+                moving.append((device, controller, target))
+        # Both axes travel at once, then each is waited for
+        for device, controller, target in moving:
+            self._select(device, controller)
+            controller.wait_for_position(target, timeout=self.timeout)
+        self.moves += len(moving)
+        self._position = (angle, height)
+
+    def _read(self):
+        sa = self.sa
+        if self._index is None:
+            points = sa.sweep_points
+            frequencies = np.linspace(sa.start_frequency, sa.stop_frequency, points)
+            step = frequencies[1] - frequencies[0] if points > 1 else 1
+            self._width = max(int(round((self.bandwidth or 0) / step)), 0)
+            self._index = np.clip(np.searchsorted(frequencies, self.suspects) - self._width, 0, points - 1)
+            self._sweep = np.empty(points, dtype=np.float32)
+            # sweep.start only waits for the sweep in single sweep mode
+            sa.write(sa.command('sweep.mode.single'))
+        sa.write(sa.command('sweep.start'))
+        sweep = sa.Trace(self.trace).array(out=self._sweep)
+        # Highest point within bandwidth of each suspect, in case it drifts between bins
+        return window_max(sweep, 2 * self._width + 1)[self._index].astype(np.float32)
+
+    @property
+    def _period(self):
+        return self.angle_range[1] - self.angle_range[0]
+
+    def _unwrap(self, angle, near):
+        '''Returns angle, or with wrap_angle its equivalent within half a turn of near'''
+        if not self.wrap_angle:
+            return angle
+        return near + (angle - near + self._period / 2) % self._period - self._period / 2
+
+    def _normalize(self, angle):
+        if not self.wrap_angle:
+            return angle
+        return self.angle_range[0] + (angle - self.angle_range[0]) % self._period
+
+    def _close(self, axis, a, b):
+        if axis == 1:
+            return abs(self._unwrap(a, b) - b) <= self.angle_tolerance / 2
+        return abs(a - b) <= self.height_tolerance / 2
+
+    def _cached(self, polarity, angle, height):
+        for (p, a, h), amplitudes in self.measurements.items():
+            if p == polarity and self._close(1, a, angle) and self._close(2, h, height):
+                return amplitudes
+        return None
+
+    def measure(self, polarity, angle, height):
+        '''Returns amplitudes at the suspects with the antenna at this position, reusing earlier sweeps'''
+        angle = self._normalize(angle)
+        amplitudes = self._cached(polarity, angle, height)
+        if amplitudes is None:
+            self._move(polarity, angle, height)
+            amplitudes = self._read()
+            self.measurements[(polarity, float(angle), float(height))] = amplitudes
+        return amplitudes
+
+    def coarse(self, angles=range(0, 360, 45), heights=(1.0, 2.5, 4.0)):
+        '''Measures every grid point, alternating the direction of each axis between passes'''
+        angles = [float(a) for a in angles]
+        heights = [float(h) for h in heights]
+        for p, polarity in enumerate(self.polarities):
+            for h, height in enumerate(heights if p % 2 == 0 else heights[::-1]):
+                for angle in (angles if (p * len(heights) + h) % 2 == 0 else angles[::-1]):
+                    self.measure(polarity, angle, height)
+
+    def _best(self, i):
+        (polarity, angle, height), amplitudes = max(self.measurements.items(), key=lambda item: item[1][i])
+        return polarity, angle, height
+
+    def _line(self, i, polarity, axis, fixed, value):
+        # Measured (position, amplitude) along one axis, angles unwrapped around value
+        return [
+            (self._unwrap(key[axis], value) if axis == 1 else key[axis], amplitudes[i])
+            for key, amplitudes in self.measurements.items()
+            if key[0] == polarity and self._close(3 - axis, key[3 - axis], fixed)]
+
+    def _neighbours(self, i, polarity, axis, fixed, value):
+        # Nearest measured points either side of value along one axis
+        points = sorted(self._line(i, polarity, axis, fixed, value))
+        below = [p for p in points if p[0] < value]
+        above = [p for p in points if p[0] > value]
+        return (below[-1] if below else None), (above[0] if above else None)
+
+    def _search(self, i, polarity, axis, fixed, value, limits, tolerance):
+        '''Refines one axis of suspect i around value and returns the best position found'''
+        def amplitude(x):
+            angle, height = (x, fixed) if axis == 1 else (fixed, x)
+            return float(self.measure(polarity, angle, height)[i])
+
+        if axis == 1 and self.wrap_angle:
+            limits = (value - self._period / 2, value + self._period / 2)
+        below, above = self._neighbours(i, polarity, axis, fixed, value)
+        low = below[0] if below else limits[0]
+        high = above[0] if above else limits[1]
+        if high - low <= tolerance:
+            return value
+
+        if below and above:
+            # Vertex of the parabola through the best point and its neighbours
+            centre = amplitude(value)
+            (x0, y0), (x2, y2) = below, above
+            denominator = (value - x0) * (centre - y2) - (value - x2) * (centre - y0)
+            if denominator:
+                vertex = value - 0.5 * ((value - x0) ** 2 * (centre - y2) - (value - x2) ** 2 * (centre - y0)) / denominator
+                if low < vertex < high and abs(vertex - value) > tolerance / 2:
+                    amplitude(vertex)
+
+        # Golden section on the bracket, measurements taken above are reused
+        a, b = low, high
+        c, d = b - INVERSE_PHI * (b - a), a + INVERSE_PHI * (b - a)
+        while b - a > tolerance:
+            if amplitude(c) >= amplitude(d):
+                b, d = d, c
+                c = b - INVERSE_PHI * (b - a)
+            else:
+                a, c = c, d
+                d = a + INVERSE_PHI * (b - a)
+
+        candidates = [(amplitude, position) for position, amplitude in self._line(i, polarity, axis, fixed, value)]
+        return self._normalize(max(candidates)[1]) if axis == 1 else max(candidates)[1]
+
+    def _order(self, suspects):
+        # Nearest neighbour tour from the current position, changing polarity as little as possible
+        remaining = list(suspects)
+        position = self._position or (self.angle_range[0], self.height_range[0])
+        polarity = self._polarity
+        order = []
+        while remaining:
+            def cost(i):
+                p, a, h = self._best(i)
+                return ((p != polarity) * 2
+                        + abs(a - position[0]) / (self.angle_range[1] - self.angle_range[0])
+                        + abs(h - position[1]) / (self.height_range[1] - self.height_range[0]))
+            i = min(remaining, key=cost)
+            remaining.remove(i)
+            order.append(i)
+            polarity, angle, height = self._best(i)
+            position = (angle, height)
+        return order
+
+    def refine(self):
+        '''Refines the angle and then height of each suspect, returns the maximum found for each.
+
+        Returns a structured array with frequency, amplitude, angle, height
+        and polarity fields, one row per suspect.
+        '''
+        if not self.measurements:
+            raise RuntimeError('Run coarse() before refine()')
+        for i in self._order(range(self.suspects.size)):
+            polarity, angle, height = self._best(i)
+            angle = self._search(i, polarity, 1, height, angle, self.angle_range, self.angle_tolerance)
+            self._search(i, polarity, 2, angle, height, self.height_range, self.height_tolerance)
+        logging.info(f'Maximized {self.suspects.size} suspects with {len(self.measurements)} sweeps and {self.moves} moves')
+        return self.results()
+
+    def results(self):
+        '''Returns the best measurement found so far for each suspect'''
+        results = np.zeros(self.suspects.size, dtype=[
+            ('frequency', 'f8'), ('amplitude', 'f4'), ('angle', 'f8'), ('height', 'f8'), ('polarity', 'U1')])
+        for i, frequency in enumerate(self.suspects):
+            polarity, angle, height = self._best(i)
+            results[i] = (frequency, self.measurements[(polarity, angle, height)][i], angle, height, polarity)
+        return results
@@ -0,0 +1,142 @@
+import logging
+import math
+import re
+import time
+
+_number = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+
+def parse_float(response):
+    '''Returns the first number in a controller response, e.g. 200.0 from "200.0OK", None if there isn't one'''
+    match = _number.search(response)
+    return float(match.group()) if match else None
+
+
+class MotionProfile:
+    '''Trapezoidal speed model of one axis used to predict how long a move takes.
+
+    Starts from the controller's speed and acceleration settings, read as
+    units per second and units per second squared, and corrects the speed
+    after every observed move so predictions follow the real axis.
+    '''
+    def __init__(self, speed=None, acceleration=None):
+        self.speed = speed or None
+        self.acceleration = acceleration or None
+        self.moves = 0
+
+    def predict(self, distance):
+        '''Returns the expected duration of a move in seconds, None until the speed is known'''
+        distance = abs(distance)
+        if not self.speed:
+            return None
+        if not self.acceleration:
+            return distance / self.speed
+        ramp = self.speed / self.acceleration
+        if distance >= self.speed * ramp:
+            return distance / self.speed + ramp
+        # Never reaches full speed
+        return 2 * math.sqrt(distance / self.acceleration)
+
+    def learn(self, distance, elapsed, early=False, weight=0.5):
+        '''Corrects the speed from a move of distance that took elapsed seconds.
+
+        early means the axis had already arrived at the first poll, so the
+        move took less than elapsed by an unknown amount and the speed is
+        raised by a fixed step instead.
+        '''
+        distance = abs(distance)
+        if distance <= 0 or elapsed <= 0:
+            return
+        self.moves += 1
+        predicted = self.predict(distance)
+        if predicted is None:
+            self.speed = distance / elapsed
+        elif early:
+            self.speed *= 1.25
+        else:
+            self.speed *= (predicted / elapsed) ** weight
+
+
+class MotionMixin:
+    '''Adds predicted arrival waiting to position controllers.
+
+    Rather than polling the position for the whole move, wait_for_position()
+    sleeps until shortly before the predicted arrival time and only polls
+    at the end, leaving the shared controller bus free in the meantime.
+    '''
+    # Seconds to start polling before the predicted arrival and between polls
+    arrival_lead = 0.5
+    poll_interval = 0.2
+
+    def _axis(self):
+        return 'axis'
+
+    def _motion(self):
+        if '_profiles' not in self.__dict__:
+            self._profiles = {}
+            self._moves = {}
+        return self._profiles, self._moves
+
+    def motion_profile(self):
+        '''Returns the motion profile of the current axis, reading its speed and acceleration the first time'''
+        profiles, moves = self._motion()
+        axis = self._axis()
+        if axis not in profiles:
+            speed = acceleration = None
+            try:
+                speed = parse_float(self.speed)
+                acceleration = parse_float(self.acceleration)
+            except Exception as e:
+                logging.info(f'Could not read speed and acceleration of {axis}, learning from moves: {e}')
+            profiles[axis] = MotionProfile(speed, acceleration)
+        return profiles[axis]
+
+    def read_position(self):
+        '''Returns the current position as a float'''
+        return parse_float(self.position)
+
+    def move_to(self, target, wait=True, tolerance=0.5, timeout=None):
+        '''Moves the current axis to target, waiting for it to arrive unless wait is False'''
+        profiles, moves = self._motion()
+        start = self.read_position()
+        self.position = target
+        moves[self._axis()] = (start, target, time.monotonic())
+        if wait:
+            return self.wait_for_position(target, tolerance, timeout)
+
+    def wait_for_position(self, target=None, tolerance=0.5, timeout=None):
+        '''Waits until the current axis is within tolerance of target and returns its position.
+
+        Defaults to the target of the last move_to().  Raises TimeoutError
+        after timeout seconds.
+        '''
+        profiles, moves = self._motion()
+        axis = self._axis()
+        start, moved_to, started = moves.get(axis, (None, target, time.monotonic()))
+        target = moved_to if target is None else target
+        deadline = None if timeout is None else started + timeout
+        profile = self.motion_profile()
+
+        if start is not None:
+            predicted = profile.predict(target - start)
+            if predicted is not None:
+                wake = started + predicted - self.arrival_lead
+                if deadline is not None:
+                    wake = min(wake, deadline)
+                time.sleep(max(wake - time.monotonic(), 0))
+
+        polls = 0
+        while True:
+            position = self.read_position()
+            now = time.monotonic()
+            polls += 1
+            if position is not None and abs(position - target) <= tolerance:
+                break
+            if deadline is not None and now + self.poll_interval > deadline:
+                raise TimeoutError(f'{axis} at {position} did not reach {target} within {timeout} s')
+            time.sleep(self.poll_interval)
+
+        if start is not None:
+            profile.learn(target - start, now - started, early=polls == 1)
+        moves.pop(axis, None)
+        return position
@@ -0,0 +1,91 @@
+from pyemi.lazy import LazyModule
+
+np = LazyModule('numpy', globals(), 'np')
+
+
+def window_max(a, width):
+    '''Returns max(a[..., i:i + width]) for each i along the last axis.
+
+    Uses a sparse table, log2(width) whole array maximums instead of a loop
+    over points, padding past the end with -inf.
+    '''
+    a = np.asarray(a, dtype=np.float64)
+    n = a.shape[-1]
+    if width <= 1:
+        return a.copy()
+    pad = np.full(a.shape[:-1] + (width,), -np.inf)
+    table = np.concatenate([a, pad], axis=-1)
+    span = 1
+    while span * 2 <= width:
+        table[..., :-span] = np.maximum(table[..., :-span], table[..., span:])
+        span *= 2
+    # Two overlapping power of two windows cover the full width
+    return np.maximum(table[..., :n], table[..., width - span:width - span + n])
+
+
+def find_peaks(amplitudes, frequencies, n=10, spacing=0, threshold=None, margin=0, above_noise=None):
+    '''Returns the n highest peaks of each sweep as (frequencies, amplitudes).
+
+    amplitudes is one sweep or a stack of sweeps with frequency as the last
+    axis.  Peaks are local maxima with no higher point within spacing Hz,
+    assuming evenly spaced frequencies.  threshold is a level, an array of
+    levels or a LimitLine, and only peaks above threshold - margin are kept.
+    above_noise keeps only peaks that many dB above each sweep's median.
+    Results have shape (..., n), highest first, padded with NaN.
+    '''
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    points = amplitudes.shape[-1]
+    step = (frequencies[-1] - frequencies[0]) / (points - 1) if points > 1 else 0
+    width = max(int(np.ceil(spacing / step)) if step else 0, 1)
+
+    # A peak is strictly above the width points to its left and at least the width points to its right
+    padded = np.concatenate([np.full(amplitudes.shape[:-1] + (width,), -np.inf), amplitudes], axis=-1)
+    around = window_max(padded, width)
+    left = around[..., :points]
+    right = np.concatenate([around[..., width + 1:], np.full(amplitudes.shape[:-1] + (1,), -np.inf)], axis=-1)
+    peak = (amplitudes > left) & (amplitudes >= right)
+
+    if threshold is not None:
+        if hasattr(threshold, 'evaluate'):
+            threshold = threshold.evaluate(frequencies)
+        peak &= amplitudes > np.asarray(threshold, dtype=np.float64) - margin
+    if above_noise is not None:
+        peak &= amplitudes > np.median(amplitudes, axis=-1, keepdims=True) + above_noise
+
+    score = np.where(peak, amplitudes, -np.inf)
+    n = min(n, points)
+    index = np.argpartition(-score, n - 1, axis=-1)[..., :n]
+    order = np.argsort(-np.take_along_axis(score, index, axis=-1), axis=-1, kind='stable')
+    index = np.take_along_axis(index, order, axis=-1)
+    found = np.take_along_axis(peak, index, axis=-1)
+    peak_amplitudes = np.where(found, np.take_along_axis(amplitudes, index, axis=-1), np.nan)
+    peak_frequencies = np.where(found, frequencies[index], np.nan)
+    return peak_frequencies, peak_amplitudes
+
+
+def merge_peaks(frequencies, amplitudes, tolerance):
+    '''Merges peaks found in many sweeps into one list of emissions.
+
+    Peaks closer than tolerance Hz to their neighbour are one emission,
+    reported at the frequency and amplitude of its highest peak.  Takes
+    find_peaks() results of any shape and returns (frequencies,
+    amplitudes, sweeps) in frequency order, where sweeps is the flat index
+    of the sweep each emission was highest in.
+    '''
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    per_sweep = frequencies.shape[-1] if frequencies.ndim else 1
+    flat = np.flatnonzero(~np.isnan(frequencies.ravel()) & ~np.isnan(amplitudes.ravel()))
+    f = frequencies.ravel()[flat]
+    a = amplitudes.ravel()[flat]
+
+    order = np.argsort(f, kind='stable')
+    f, a, flat = f[order], a[order], flat[order]
+    cluster = np.concatenate([[0], np.cumsum(np.diff(f) > tolerance)])
+
+    # Highest peak first within each cluster, then the first row of each cluster
+    order = np.lexsort((-a, cluster))
+    first = np.concatenate([[True], np.diff(cluster[order]) > 0]) if order.size else np.zeros(0, dtype=bool)
+    best = order[first]
+    return f[best], a[best], flat[best] // per_sweep
@@ -0,0 +1,199 @@
+from pyemi.lazy import LazyModule
+from pyemi.transfer import read_block_header, read_block_data, read_binary_block, parse_ascii
+
+np = LazyModule('numpy', globals(), 'np')
+
+MAX_RANGES = 100
+
+# Shortest measurement time in seconds that gives a settled reading for each
+# receiver detector on steady signals, adjust for intermittent emissions
+MIN_DWELL = {'POS': 0.001, 'NEG': 0.001, 'RMS': 0.01, 'AVER': 0.01, 'CRMS': 0.1, 'CAV': 0.1, 'QP': 1.0}
+MAX_DETECTORS = 4
+
+
+class ReceiverScan:
+    '''EMI receiver scan over up to 100 frequency ranges using the driver's scan commands.
+
+    Example:
+        scan = ReceiverScan(sa)
+        scan.add_range(150e3, 30e6, 4.5e3, rbw=9e3, time=1e-3)
+        scan.add_range(30e6, 1e9, 30e3, rbw=120e3, time=1e-3)
+        scan.configure()
+        frequencies, amplitudes = scan.run()
+    '''
+    def __init__(self, sa, trace=1):
+        self.sa = sa
+        self.trace = trace
+        self.ranges = []
+        self.frequencies = None
+        self.amplitudes = None
+
+    def add_range(self, start, stop, step, rbw=None, time=None, attenuation=None, preamp=None, rf_input=None, name=None):
+        '''Adds a scan range, frequencies in Hz and measurement time in seconds'''
+        if len(self.ranges) >= MAX_RANGES:
+            raise ValueError(f'A scan can have at most {MAX_RANGES} ranges')
+        if stop <= start or step <= 0:
+            raise ValueError(f'Invalid scan range {start} to {stop} Hz in steps of {step} Hz')
+        self.ranges.append({
+            'start': start, 'stop': stop, 'step': step, 'rbw': rbw, 'time': time,
+            'attenuation': attenuation, 'preamp': preamp, 'rf_input': rf_input, 'name': name,
+        })
+
+    @property
+    def points(self):
+        '''Number of points in each range'''
+        return [int((r['stop'] - r['start']) // r['step']) + 1 for r in self.ranges]
+
+    def configure(self):
+        '''Sends every range setting in one batch and preallocates the result arrays'''
+        sa = self.sa
+        with sa.batch(opc=True):
+            sa.mode = 'REC'
+            sa.write(sa.command('scan.mode', 'SCAN'))
+            sa.write(sa.command('scan.ranges', 1, len(self.ranges)))
+            for i, r in enumerate(self.ranges, 1):
+                sa.write(sa.command('scan.frequency.start', i, r['start'], 'Hz'))
+                sa.write(sa.command('scan.frequency.stop', i, r['stop'], 'Hz'))
+                sa.write(sa.command('scan.frequency.step', i, r['step'], 'Hz'))
+                if r['rbw'] is not None:
+                    sa.write(sa.command('scan.rbw', i, r['rbw'], 'Hz'))
+                if r['time'] is not None:
+                    sa.write(sa.command('scan.time', i, round(r['time'] * 1e6), 'us'))
+                if r['attenuation'] is not None:
+                    sa.write(sa.command('scan.attenuation.off', i))
+                    sa.write(sa.command('scan.attenuation.value', i, r['attenuation']))
+                if r['preamp'] is not None:
+                    sa.write(sa.command('scan.preamp.state', i, 'ON' if r['preamp'] else 'OFF'))
+                if r['rf_input'] is not None:
+                    sa.write(sa.command('scan.input', i, f'INPUT{r["rf_input"]}'))
+                if r['name'] is not None:
+                    sa.write(sa.command('scan.name', i, r['name']))
+            sa.format = ('REAL', 32)
+
+        points = self.points
+        self.frequencies = np.empty(sum(points), dtype=np.float64)
+        self.amplitudes = np.empty(sum(points), dtype=np.float32)
+        offset = 0
+        for r, n in zip(self.ranges, points):
+            frequencies = self.frequencies[offset:offset + n]
+            np.multiply(np.arange(n, dtype=np.float64), r['step'], out=frequencies)
+            frequencies += r['start']
+            offset += n
+
+    def start(self):
+        '''Starts a single scan without waiting for it'''
+        self.sa.write(self.sa.command('scan.single'))
+        self.sa.write(self.sa.command('scan.trigger'))
+
+    def read(self, chunk_size=1 << 20):
+        '''Reads the scan result in chunks into the preallocated amplitude array.
+
+        If the instrument returns a different number of points than the
+        ranges predict, e.g. in time domain mode, the frequency axis is read
+        from the instrument instead.  Returns (frequencies, amplitudes).
+        '''
+        sa = self.sa
+        sa.format = ('REAL', 32)
+        sa.write(sa.command('trace.values', self.trace))
+        length = read_block_header(sa.resource)
+        points = length // 4
+        if self.amplitudes is None or self.amplitudes.size != points:
+            self.amplitudes = np.empty(points, dtype=np.float32)
+            self.frequencies = None
+        read_block_data(sa.resource, length, self.amplitudes, np.float32, chunk_size)
+
+        if self.frequencies is None:
+            # Double precision keeps the axis exact above 16 MHz
+            sa.format = ('REAL', 64)
+            sa.write(sa.command('trace.frequencies', self.trace))
+            self.frequencies = read_binary_block(sa.resource, np.float64, chunk_size=chunk_size)
+            sa.format = ('REAL', 32)
+        return self.frequencies, self.amplitudes
+
+    def run(self, timeout=None, chunk_size=1 << 20):
+        '''Runs a single scan, waits for it to complete and returns (frequencies, amplitudes)'''
+        self.start()
+        self.sa.wait_complete(timeout)
+        return self.read(chunk_size)
+
+
+class BargraphSampler:
+    '''Fixed frequency receiver readings with up to 4 detectors at once.
+
+    Each frequency costs no bus transaction of its own, tuning, a single
+    measurement and the bargraph read are batched for as many frequencies
+    as fit in the resource timeout.  With a limit, slow detectors such as
+    QP are only measured where the peak reading comes within margin dB of
+    it, since QP and average readings never exceed the peak.
+
+    Example:
+        sampler = BargraphSampler(sa, detectors=('POS', 'QP', 'CAV'))
+        readings = sampler.measure(suspects, limit=limit_values)
+        qp = readings[:, sampler.detectors.index('QP')]
+    '''
+    def __init__(self, sa, detectors=('POS', 'QP', 'AVER'), min_dwell=None):
+        if not 0 < len(detectors) <= MAX_DETECTORS:
+            raise ValueError(f'Choose 1 to {MAX_DETECTORS} detectors')
+        self.sa = sa
+        self.detectors = [d.upper() for d in detectors]
+        self.min_dwell = dict(MIN_DWELL, **(min_dwell or {}))
+        self.skipped = None
+
+    def dwell(self, detectors, dwell=None):
+        '''Measurement time for a set of detectors, the slowest one's minimum unless dwell is longer'''
+        return max([dwell or 0] + [self.min_dwell.get(d, 0) for d in detectors])
+
+    def measure(self, frequencies, dwell=None, limit=None, margin=6.0):
+        '''Returns readings at each frequency in Hz, shape (frequencies, detectors).
+
+        limit is a level, or one level per frequency, in the analyzer's
+        amplitude units.  Readings that were skipped are NaN and marked in
+        the skipped mask.
+        '''
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        readings = np.full((frequencies.size, len(self.detectors)), np.nan, dtype=np.float32)
+        self.skipped = np.zeros(readings.shape, dtype=bool)
+        self.sa.mode = 'REC'
+
+        fast = [d for d in self.detectors if d in ('POS', 'NEG')]
+        slow = [d for d in self.detectors if d not in fast]
+        if limit is None or 'POS' not in fast or not slow:
+            self._sample(frequencies, self.detectors, self.dwell(self.detectors, dwell), readings)
+            return readings
+
+        # Peak first at its short dwell, then slow detectors only near the limit
+        self._sample(frequencies, fast, self.dwell(fast, dwell), readings)
+        peak = readings[:, self.detectors.index('POS')]
+        suspect = peak >= np.broadcast_to(np.asarray(limit, dtype=np.float32), peak.shape) - margin
+        columns = [self.detectors.index(d) for d in slow]
+        self.skipped[np.ix_(~suspect, columns)] = True
+        if suspect.any():
+            readings[suspect] = self._sample(frequencies[suspect], slow, self.dwell(slow, dwell), readings[suspect])
+        return readings
+
+    def _sample(self, frequencies, detectors, dwell, readings):
+        sa = self.sa
+        columns = [self.detectors.index(d) for d in detectors]
+        # Tune in ascending order and fit each batch comfortably within the timeout
+        order = np.argsort(frequencies, kind='stable')
+        timeout = sa.resource.timeout / 1000 if sa.resource.timeout else 10
+        per_batch = max(int(timeout / 2 / (dwell + 0.01)), 1)
+
+        with sa.batch():
+            sa.write(sa.command('bargraph.detector', ','.join(detectors)))
+            sa.write(sa.command('sweep.time', round(dwell * 1e6), 'us'))
+            sa.write(sa.command('sweep.mode.single'))
+
+        def store(i):
+            def parse(data):
+                readings[i, columns] = parse_ascii(data, np.float32)
+            return parse
+
+        for first in range(0, order.size, per_batch):
+            with sa.batch():
+                for i in order[first:first + per_batch]:
+                    sa.write(sa.command('frequency.center.set', frequencies[i], 'Hz'))
+                    sa.write(sa.command('sweep.start'))
+                    sa.query(sa.command('bargraph.current'), store(i))
+        sa.invalidate('frequency.center', 'frequency.start', 'frequency.stop', 'frequency.span')
+        return readings
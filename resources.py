@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from pyemi.lazy import LazyModule
+
+visa = LazyModule('pyvisa', globals(), 'visa')
+
+
+class ResourcePool:
+    '''Process wide VISA sessions shared by resource string.
+
+    The ResourceManager is created on first use and each resource is opened
+    on its first I/O, so instruments that point at the same address, such as
+    a Tower and Turntable on one controller, share a single session.  With
+    idle_timeout set, sessions unused for that many seconds are closed and
+    reopened transparently on their next use.  Sessions held with in_use()
+    are never closed as idle, however long the call takes.
+
+    factory creates the ResourceManager, pyvisa's by default.  Replace it,
+    e.g. with a simulated backend, before any session is opened.
+    '''
+    def __init__(self, idle_timeout=None, factory=None):
+        self.idle_timeout = idle_timeout
+        self.factory = factory
+        self._rm = None
+        self._resources = {}
+        self._last_used = {}
+        # Calls in progress per resource string, see in_use()
+        self._busy = {}
+        self._attributes = {}
+        self._last_eviction = time.monotonic()
+        self._lock = threading.RLock()
+
+    @property
+    def resource_manager(self):
+        with self._lock:
+            if self._rm is None:
+                self._rm = self.factory() if self.factory else visa.ResourceManager()
+            return self._rm
+
+    def get(self, resource_string):
+        '''Returns the open session for resource_string, opening it if needed'''
+        now = time.monotonic()
+        with self._lock:
+            if self.idle_timeout is not None and now - self._last_eviction > min(self.idle_timeout, 1):
+                self.evict_idle(now)
+            resource = self._resources.get(resource_string)
+            if resource is None:
+                logging.info(f'Opening resource: {resource_string}')
+                resource = self.resource_manager.open_resource(resource_string)
+                for name, value in self._attributes.get(resource_string, {}).items():
+                    setattr(resource, name, value)
+                self._resources[resource_string] = resource
+            self._last_used[resource_string] = now
+            return resource
+
+    @contextmanager
+    def in_use(self, resource_string):
+        '''Keeps the session open for a call that holds it, e.g. a long query or wait'''
+        with self._lock:
+            self._busy[resource_string] = self._busy.get(resource_string, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._busy[resource_string] -= 1
+                if not self._busy[resource_string]:
+                    del self._busy[resource_string]
+                if resource_string in self._resources:
+                    self._last_used[resource_string] = time.monotonic()
+
+    def configure(self, resource_string, **attributes):
+        '''Sets resource attributes now if open and again whenever it is reopened'''
+        with self._lock:
+            self._attributes.setdefault(resource_string, {}).update(attributes)
+            resource = self._resources.get(resource_string)
+            if resource is not None:
+                for name, value in attributes.items():
+                    setattr(resource, name, value)
+
+    def is_open(self, resource_string):
+        return resource_string in self._resources
+
+    def close(self, resource_string):
+        '''Closes the session for resource_string, it reopens on next use'''
+        with self._lock:
+            resource = self._resources.pop(resource_string, None)
+            self._last_used.pop(resource_string, None)
+            if resource is not None:
+                logging.info(f'Closing resource: {resource_string}')
+                resource.close()
+
+    def close_all(self):
+        '''Closes every session and the ResourceManager'''
+        with self._lock:
+            for resource_string in list(self._resources):
+                self.close(resource_string)
+            if self._rm is not None:
+                self._rm.close()
+                self._rm = None
+
+    def evict_idle(self, now=None):
+        '''Closes sessions that have not been used for idle_timeout seconds and are not in use'''
+        if self.idle_timeout is None:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._last_eviction = now
+            for resource_string, last_used in list(self._last_used.items()):
+                if now - last_used > self.idle_timeout and resource_string not in self._busy:
+                    self.close(resource_string)
+
+
+pool = ResourcePool()
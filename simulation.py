@@ -0,0 +1,483 @@
+import logging
+import re
+import time
+
+from pyemi.commands import compile_driver, _placeholder
+from pyemi.instruments import BaseInstrument, FREQUENCY_UNITS
+from pyemi.lazy import LazyModule
+from pyemi.resources import pool
+
+np = LazyModule('numpy', globals(), 'np')
+visa = LazyModule('pyvisa', globals(), 'visa')
+
+_integer = r'([-+]?\d+)'
+_float = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+
+# Settings of a freshly reset instrument, by driver key
+DEFAULTS = {
+    'frequency.start': 30e6, 'frequency.stop': 1e9, 'sweep.points': 1001, 'rbw': 120e3, 'vbw': 300e3,
+    'amplitude.units': 'DBUV', 'sweep.count': 1, 'sweep.mode': 1, 'output': 'OFF', 'level': '-30',
+    'unit': 'DBM', 'frequency.discrete': 1e9, 'speed': 10.0, 'acceleration': 0.0, 'polarity': 'V',
+    'frequency.mode': 'CW',
+}
+
+# Event status register bit set by a command the instrument does not accept
+ESR_COMMAND_ERROR = 32
+
+# Narrowband emissions in every synthetic trace, (frequency Hz, level dBuV)
+EMISSIONS = [(48e6 * n, 52 - 3 * n) for n in range(1, 12)] + [(125e6, 44), (433.92e6, 38), (2.4e9, 50)]
+
+
+def _pattern(template):
+    '''Builds a regex matching a command template and the converters for its values'''
+    pattern, converters, position = '', [], 0
+    matches = list(_placeholder.finditer(template))
+    for i, match in enumerate(matches):
+        pattern += re.escape(template[position:match.start()])
+        position = match.end()
+        conversion = match.group(1)
+        if conversion == '%':
+            pattern += '%'
+        elif conversion in 'diuoxX':
+            pattern += _integer
+            converters.append(int)
+        elif conversion in 'eEfFgG':
+            pattern += _float
+            converters.append(float)
+        else:
+            # Text runs to the next literal, or the end of the command
+            pattern += r'(.*?)' if i == len(matches) - 1 else r'(\S*?)'
+            converters.append(str)
+    pattern += re.escape(template[position:])
+    return re.compile(f'^{pattern}$', re.IGNORECASE), converters
+
+
+class SimulatedResource:
+    '''Stands in for a pyvisa resource, answering the commands of a driver YAML.
+
+    Settings written are kept and read back, traces are synthetic noise
+    with a few emissions in ASCII or binary blocks following the format
+    setting, and axes move at their speed setting.  Every transaction
+    costs latency seconds plus its size over bandwidth bytes per second,
+    counted in stats and slept unless realtime is False.  Single sweeps
+    take sweep_time seconds to complete.
+    '''
+    def __init__(self, resource_string, driver, latency=0.001, bandwidth=1e6, sweep_time=0.0, realtime=True, seed=0):
+        self.resource_string = resource_string
+        self.driver = driver
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sweep_time = sweep_time
+        self.realtime = realtime
+        self.timeout = 2000
+        self.write_termination = '\n'
+        self.read_termination = None
+        self.query_delay = 0.0
+        self.commands, compiled = compile_driver(BaseInstrument.driver_folder / driver)
+        getters = {key[:-4]: command.arity for key, command in compiled.items() if key.endswith('.get')}
+        self._getters = getters
+        # Most literal text first so specific templates win over general ones
+        self._table = sorted(
+            ((key,) + _pattern(command.template.lstrip(':')) for key, command in compiled.items()),
+            key=lambda entry: -len(_placeholder.sub('', compiled[entry[0]].template)))
+        self._matches = {}
+        self._rng = np.random.default_rng(seed)
+        self._output = b''
+        self._unread = False
+        self.stats = {}
+        self.reset_stats()
+        self.reset()
+
+    def reset_stats(self):
+        self.stats.update({'transactions': 0, 'writes': 0, 'reads': 0, 'bytes_written': 0, 'bytes_read': 0, 'bus_time': 0.0})
+
+    def reset(self):
+        '''Returns every setting to its default'''
+        self.state = {}
+        self.format = ('ASC', 0)
+        self.esr = 0
+        self.ese = 0
+        self.sre = 0
+        self._opc_pending = False
+        self._busy_until = 0.0
+        self._axes = {}
+        self._list_started = None
+
+    def _charge(self, size, turnaround=True):
+        seconds = (self.latency if turnaround else 0) + size / self.bandwidth
+        self.stats['bus_time'] += seconds
+        if self.realtime and seconds > 0:
+            time.sleep(seconds)
+
+    # pyvisa resource interface
+
+    def write(self, message):
+        self.stats['transactions'] += 1
+        self.stats['writes'] += 1
+        self.stats['bytes_written'] += len(message) + len(self.write_termination or '')
+        self._charge(len(message))
+        responses = []
+        for part in message.split(';'):
+            part = part.strip().lstrip(':')
+            if part:
+                response = self._execute(part)
+                if response is not None:
+                    responses.append(response if isinstance(response, bytes) else str(response).encode())
+        if responses:
+            self._output = b';'.join(responses) + b'\n'
+            self._unread = True
+        return len(message)
+
+    def write_raw(self, message):
+        self.stats['transactions'] += 1
+        self.stats['writes'] += 1
+        self.stats['bytes_written'] += len(message)
+        self._charge(len(message))
+        # Binary block uploads, e.g. list mode tables, are kept as float64 arrays
+        command, _, block = message.partition(b' #')
+        digits = int(block[:1])
+        length = int(block[1:1 + digits])
+        key, values = self._match(command.decode().strip().lstrip(':'))
+        self.state[(key, ())] = (np.frombuffer(block[1 + digits:1 + digits + length], dtype='<f8'),)
+        return len(message)
+
+    def _respond(self):
+        if self._unread:
+            self.stats['transactions'] += 1
+            self.stats['reads'] += 1
+            self.stats['bytes_read'] += len(self._output)
+            self._charge(len(self._output))
+            self._unread = False
+
+    def read_bytes(self, count, **kwargs):
+        self._respond()
+        data, self._output = self._output[:count], self._output[count:]
+        return data
+
+    def read_raw(self, size=None):
+        self._respond()
+        data, self._output = self._output, b''
+        return data
+
+    def read(self, termination=None, encoding=None):
+        return self.read_raw().decode('ascii', errors='replace').rstrip('\n')
+
+    def query(self, message, delay=None):
+        self.write(message)
+        delay = self.query_delay if delay is None else delay
+        if delay and self.realtime:
+            time.sleep(delay)
+        return self.read()
+
+    def clear(self):
+        self._output = b''
+        self._unread = False
+
+    def close(self):
+        pass
+
+    def enable_event(self, *args, **kwargs):
+        pass
+
+    def disable_event(self, *args, **kwargs):
+        pass
+
+    def wait_on_event(self, event_type, timeout, *args, **kwargs):
+        self._wait(timeout / 1000)
+        self._update_opc()
+        if not self.esr & self.ese:
+            raise visa.errors.VisaIOError(visa.constants.VI_ERROR_TMO)
+
+    def read_stb(self):
+        self._update_opc()
+        return 64 | 32 if self.esr & self.ese and self.sre & 32 else 0
+
+    # Instrument model
+
+    def _wait(self, limit=None):
+        remaining = self._busy_until - time.monotonic()
+        if limit is not None:
+            remaining = min(remaining, limit)
+        if remaining > 0 and self.realtime:
+            time.sleep(remaining)
+
+    def _update_opc(self):
+        if self._opc_pending and (not self.realtime or time.monotonic() >= self._busy_until):
+            self.esr |= 1
+            self._opc_pending = False
+
+    def _match(self, part):
+        if part not in self._matches:
+            for key, pattern, converters in self._table:
+                match = pattern.match(part)
+                if match:
+                    values = tuple(convert(value) for convert, value in zip(converters, match.groups()))
+                    self._matches[part] = (key, values)
+                    break
+            else:
+                self._matches[part] = (None, ())
+        return self._matches[part]
+
+    def _execute(self, part):
+        common = part.upper()
+        if common.startswith('*'):
+            return self._common(common)
+        key, values = self._match(part)
+        if key is None:
+            logging.warning(f'{self.resource_string}: unknown command {part!r}')
+            self.esr |= ESR_COMMAND_ERROR
+            return '0' if '?' in part else None
+
+        handler = getattr(self, '_' + key.replace('.', '_'), None)
+        if handler is not None:
+            return handler(*values)
+        if key.endswith('.get'):
+            return self._get(key[:-4], values)
+        if key.endswith('.set'):
+            base = key[:-4]
+            prefix = self._getters.get(base, 0)
+            self.state[(base, values[:prefix])] = values[prefix:]
+            return None
+        self.state[(key, ())] = values
+        return '0' if '?' in part else None
+
+    def _common(self, command):
+        name, _, value = command.partition(' ')
+        if name == '*OPC?':
+            self._wait()
+            return '1'
+        if name == '*OPC':
+            self._opc_pending = True
+            self._update_opc()
+        elif name == '*ESR?':
+            self._update_opc()
+            esr, self.esr = self.esr, 0
+            return str(esr)
+        elif name == '*ESE':
+            self.ese = int(value)
+        elif name == '*SRE':
+            self.sre = int(value)
+        elif name == '*WAI':
+            self._wait()
+        elif name == '*CLS':
+            self.esr = 0
+        elif name == '*RST':
+            self.reset()
+        elif name == '*IDN?':
+            return f'pyemi,Simulated {self.driver},0,0'
+        elif name.endswith('?'):
+            return '0'
+        return None
+
+    def _get(self, base, values):
+        stored = self.state.get((base, values))
+        if stored is None:
+            stored = (DEFAULTS.get(base, 0),)
+        return ','.join(str(v) for v in stored)
+
+    def _hz(self, key, value, unit='Hz'):
+        self.state[(key, ())] = (value * FREQUENCY_UNITS.get(str(unit).strip().lower(), 1),)
+
+    def _value(self, key):
+        return self.state.get((key, ()), (DEFAULTS.get(key, 0),))[0]
+
+    # Spectrum analyzer
+
+    def _frequency_start_set(self, value, unit='Hz'):
+        self._hz('frequency.start', value, unit)
+
+    def _frequency_stop_set(self, value, unit='Hz'):
+        self._hz('frequency.stop', value, unit)
+
+    def _frequency_center_set(self, value, unit='Hz'):
+        span = self._value('frequency.stop') - self._value('frequency.start')
+        center = value * FREQUENCY_UNITS.get(str(unit).strip().lower(), 1)
+        self.state[('frequency.start', ())] = (center - span / 2,)
+        self.state[('frequency.stop', ())] = (center + span / 2,)
+
+    def _frequency_span_set(self, value, unit='Hz'):
+        center = (self._value('frequency.stop') + self._value('frequency.start')) / 2
+        span = value * FREQUENCY_UNITS.get(str(unit).strip().lower(), 1)
+        self.state[('frequency.start', ())] = (center - span / 2,)
+        self.state[('frequency.stop', ())] = (center + span / 2,)
+
+    def _frequency_start_get(self):
+        return f'{self._value("frequency.start"):.9E}'
+
+    def _frequency_stop_get(self):
+        return f'{self._value("frequency.stop"):.9E}'
+
+    def _frequency_center_get(self):
+        return f'{(self._value("frequency.start") + self._value("frequency.stop")) / 2:.9E}'
+
+    def _frequency_span_get(self):
+        return f'{self._value("frequency.stop") - self._value("frequency.start"):.9E}'
+
+    def _rbw_set(self, value, unit='Hz'):
+        self._hz('rbw', value, unit)
+
+    def _vbw_set(self, value, unit='Hz'):
+        self._hz('vbw', value, unit)
+
+    def _format_binary(self, kind, bits):
+        self.format = (kind.upper(), bits)
+
+    def _format_ascii(self):
+        self.format = ('ASC', 0)
+
+    def _format_get(self):
+        return f'{self.format[0]},{self.format[1]}'
+
+    def _sweep_start(self):
+        self._sweep_trigger()
+        self._wait()
+
+    def _sweep_trigger(self):
+        self._busy_until = max(self._busy_until, time.monotonic()) + self.sweep_time
+
+    def _scan_trigger(self):
+        self._sweep_trigger()
+
+    def _trace_values(self, trace):
+        start, stop = self._value('frequency.start'), self._value('frequency.stop')
+        frequencies = np.linspace(start, stop, int(self._value('sweep.points')))
+        return self._encode(self.spectrum(frequencies))
+
+    def _trace_frequencies(self, trace):
+        start, stop = self._value('frequency.start'), self._value('frequency.stop')
+        return self._encode(np.linspace(start, stop, int(self._value('sweep.points'))))
+
+    def _bargraph_current(self):
+        detectors = self.state.get(('bargraph.detector', ()), ('POS',))[0].split(',')
+        center = (self._value('frequency.start') + self._value('frequency.stop')) / 2
+        level = self.spectrum(np.array([center]))[0]
+        return ','.join(f'{level - 2 * i:.2f}' for i in range(len(detectors)))
+
+    def spectrum(self, frequencies):
+        '''Returns synthetic amplitudes in dBuV, noise with narrowband emissions'''
+        rbw = self._value('rbw') or 120e3
+        amplitudes = 10 + 10 * np.log10(rbw / 120e3) + self._rng.normal(0, 1.5, frequencies.size)
+        for frequency, level in EMISSIONS:
+            near = np.abs(frequencies - frequency) < 4 * rbw
+            if near.any():
+                response = level - 3 * ((frequencies[near] - frequency) / rbw) ** 2
+                amplitudes[near] = np.maximum(amplitudes[near], response)
+        return amplitudes
+
+    def _encode(self, values):
+        if self.format[0] == 'ASC':
+            return ','.join(map('{:.2f}'.format, np.asarray(values).tolist()))
+        dtype = '<f8' if self.format[1] == 64 else '<f4'
+        data = np.asarray(values, dtype=dtype).tobytes()
+        length = str(len(data))
+        return b'#' + str(len(length)).encode() + length.encode() + data
+
+    # Signal generator
+
+    def _frequency_mode(self, mode):
+        mode = mode.strip().upper()
+        if mode not in ('CW', 'FIX', 'FIXED', 'SWE', 'SWEEP', 'LIST'):
+            # A command error, as the generator would report it
+            logging.warning(f'{self.resource_string}: invalid frequency mode {mode!r}')
+            self.esr |= ESR_COMMAND_ERROR
+            return
+        self.state[('frequency.mode', ())] = (mode,)
+
+    def _list_trigger_execute(self):
+        self._list_started = time.monotonic()
+
+    def _list_index(self):
+        dwell = self.state.get(('list.dwell.list', ()), (np.zeros(1),))[0]
+        started = self._list_started
+        if started is None or not dwell.size or self._value('frequency.mode') != 'LIST':
+            return '0'
+        if not self.realtime:
+            return str(dwell.size - 1)
+        index = np.searchsorted(np.cumsum(dwell), time.monotonic() - started, side='right')
+        return str(min(index, dwell.size - 1))
+
+    # Position controllers
+
+    def _axis(self, device):
+        return self._axes.setdefault(device, {'from': 0.0, 'to': 0.0, 'started': 0.0})
+
+    def _position_now(self, device):
+        axis = self._axis(device)
+        speed = float(self.state.get(('speed', (device,)), (DEFAULTS['speed'],))[0]) or DEFAULTS['speed']
+        distance = axis['to'] - axis['from']
+        travelled = min(abs(distance), speed * (time.monotonic() - axis['started']))
+        return axis['from'] + travelled * (1 if distance >= 0 else -1)
+
+    def _position_set(self, device, target):
+        axis = self._axis(device)
+        axis['from'] = self._position_now(device)
+        axis['to'] = target
+        axis['started'] = time.monotonic()
+        if not self.realtime:
+            axis['from'] = target
+
+    def _position_get(self, device):
+        return f'{self._position_now(device):.1f}'
+
+    def _opc(self, device):
+        arrived = self._position_now(device) == self._axis(device)['to']
+        return '1' if arrived else '0'
+
+
+class SimulatedResourceManager:
+    '''Opens SimulatedResources for the resource strings it was given drivers for.
+
+    Example:
+        rm = SimulatedResourceManager({'GPIB0::20::INSTR': 'esw.yaml'}, latency=0.002)
+    '''
+    def __init__(self, drivers=None, **model):
+        self.drivers = {}
+        self.model = model
+        self.opened = []
+        for resource_string, driver in (drivers or {}).items():
+            self.add(resource_string, driver)
+
+    def add(self, resource_string, driver):
+        '''Simulates the instrument described by driver at resource_string'''
+        self.drivers[resource_string.upper()] = driver
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.drivers)
+
+    def open_resource(self, resource_string, **kwargs):
+        driver = self.drivers.get(resource_string.upper())
+        if driver is None:
+            raise ValueError(f'No simulated instrument at {resource_string}')
+        resource = SimulatedResource(resource_string.upper(), driver, **self.model)
+        for name, value in kwargs.items():
+            setattr(resource, name, value)
+        self.opened.append(resource)
+        return resource
+
+    def stats(self):
+        '''Returns the bus statistics summed over every resource opened'''
+        totals = {}
+        for resource in self.opened:
+            for name, value in resource.stats.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def reset_stats(self):
+        for resource in self.opened:
+            resource.reset_stats()
+
+    def close(self):
+        pass
+
+
+def simulate(drivers, **model):
+    '''Routes every instrument through simulated resources and returns the manager.
+
+    drivers maps resource strings to driver files, model takes the
+    SimulatedResource latency, bandwidth, sweep_time and realtime settings.
+    Open sessions are closed so instruments reconnect to the simulation.
+    '''
+    rm = SimulatedResourceManager(drivers, **model)
+    pool.close_all()
+    pool.factory = lambda: rm
+    return rm
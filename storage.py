@@ -0,0 +1,193 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from pyemi.lazy import LazyModule
+
+np = LazyModule('numpy', globals(), 'np')
+
+VERSION = 1
+
+# Per sweep metadata, NaN or empty when not known
+METADATA = [
+    ('timestamp', '<f8'), ('trace', '<i2'), ('rbw', '<f8'), ('vbw', '<f8'),
+    ('detector', '<U8'), ('units', '<U8'), ('angle', '<f8'), ('height', '<f8'), ('polarity', '<U1'),
+]
+
+
+class SweepStore:
+    '''Append only sweep storage on disk, read back through memory maps.
+
+    A store is a folder holding the frequency axis, one float32 row of
+    amplitudes per sweep and one fixed size metadata record per sweep.
+    Appending writes to the end of the files, so campaigns of any length
+    use constant memory, and readers slice by frequency or metadata
+    without loading the rest of the file.  The metadata record is written
+    last and marks a sweep complete, so rows left by an interrupted append
+    are ignored and trimmed before the next one.
+
+    Example:
+        with SweepStore('campaign') as store:
+            store.append(sa.Trace(1).array(), sa=sa, trace=1, turntable=controller)
+
+        store = SweepStore('campaign')
+        frequencies, amplitudes = store.select(30e6, 230e6, polarity='V')
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.frequencies = None
+        self.points = None
+        self._amplitudes = None
+        self._metadata = None
+        self._header = self.path / 'store.json'
+        if self._header.exists():
+            header = json.loads(self._header.read_text())
+            self.frequencies = np.load(self.path / 'frequencies.npy')
+            self.points = header['points']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def metadata_dtype(self):
+        return np.dtype(METADATA)
+
+    def _create(self, frequencies):
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.points = self.frequencies.size
+        np.save(self.path / 'frequencies.npy', self.frequencies)
+        self._header.write_text(json.dumps({'version': VERSION, 'points': self.points, 'metadata': METADATA}))
+
+    def append(self, amplitudes, frequencies=None, sa=None, trace=None, turntable=None, tower=None, **metadata):
+        '''Appends one sweep with metadata read from the instruments given.
+
+        amplitudes can be an array, a TraceResult or a dataframe from Trace.dataframe().
+        Settings come from sa (rbw, vbw, units and the trace detector), the
+        turntable angle and the tower height and polarity.  Keyword
+        arguments override any of them.  The first sweep sets the frequency
+        axis, from frequencies or the analyzer's start and stop frequency.
+        '''
+        if hasattr(amplitudes, 'to_pandas'):
+            frequencies = amplitudes.frequencies if frequencies is None else frequencies
+            amplitudes = amplitudes.amplitudes
+        elif hasattr(amplitudes, 'iloc'):
+            frequencies = amplitudes.iloc[:, 0].to_numpy() if frequencies is None else frequencies
+            amplitudes = amplitudes.iloc[:, 1].to_numpy()
+        amplitudes = np.ascontiguousarray(amplitudes, dtype='<f4')
+
+        if self.frequencies is None:
+            if frequencies is None and sa is not None:
+                frequencies = np.linspace(sa.start_frequency, sa.stop_frequency, amplitudes.size)
+            if frequencies is None:
+                raise ValueError('The first sweep needs frequencies or an analyzer to read them from')
+            self._create(frequencies)
+        if amplitudes.size != self.points:
+            raise ValueError(f'Sweep has {amplitudes.size} points, the store holds {self.points}')
+
+        record = np.zeros(1, dtype=self.metadata_dtype)
+        for name in ('rbw', 'vbw', 'angle', 'height'):
+            record[name] = np.nan
+        record['timestamp'] = time.time()
+        record['trace'] = trace or 0
+        if sa is not None:
+            record['rbw'] = sa.rbw
+            record['vbw'] = sa.vbw
+            record['units'] = sa.amplitude_units
+            if trace is not None:
+                record['detector'] = sa.Trace(trace).detector.strip()
+        if turntable is not None:
+            record['angle'] = _position(turntable, 'turntable')
+        if tower is not None:
+            record['height'] = _position(tower, 'tower')
+            record['polarity'] = tower.polarity.strip()[-1:]
+        for name, value in metadata.items():
+            record[name] = value
+
+        self._amplitudes = self._metadata = None
+        self._trim()
+        with open(self.path / 'amplitudes.f32', 'ab') as f:
+            f.write(amplitudes.tobytes())
+        with open(self.path / 'metadata.bin', 'ab') as f:
+            f.write(record.tobytes())
+        # Maps are reopened to include the new sweep on the next read
+        self._amplitudes = self._metadata = None
+
+    def _rows(self, name, size):
+        path = self.path / name
+        return os.path.getsize(path) // size if path.exists() else 0
+
+    def _trim(self):
+        # Drops amplitudes or partial records beyond the last complete sweep
+        count = len(self)
+        for name, size in (('amplitudes.f32', 4 * self.points), ('metadata.bin', self.metadata_dtype.itemsize)):
+            path = self.path / name
+            if path.exists() and os.path.getsize(path) > count * size:
+                os.truncate(path, count * size)
+
+    def __len__(self):
+        if self.frequencies is None:
+            return 0
+        return min(self._rows('amplitudes.f32', 4 * self.points), self._rows('metadata.bin', self.metadata_dtype.itemsize))
+
+    @property
+    def amplitudes(self):
+        '''Memory map of every sweep, shape (sweeps, points)'''
+        if self._amplitudes is None:
+            count = len(self)
+            if count == 0:
+                return np.empty((0, self.points or 0), dtype='<f4')
+            self._amplitudes = np.memmap(self.path / 'amplitudes.f32', dtype='<f4', mode='r', shape=(count, self.points))
+        return self._amplitudes
+
+    @property
+    def metadata(self):
+        '''Memory map of the metadata records, one per sweep'''
+        if self._metadata is None:
+            count = len(self)
+            if count == 0:
+                return np.empty(0, dtype=self.metadata_dtype)
+            self._metadata = np.memmap(self.path / 'metadata.bin', dtype=self.metadata_dtype, mode='r', shape=(count,))
+        return self._metadata
+
+    def select(self, start=None, stop=None, where=None, **equals):
+        '''Returns (frequencies, amplitudes) between start and stop Hz for matching sweeps.
+
+        where is a boolean mask over sweeps or a function of the metadata
+        records returning one, equals matches metadata fields exactly, e.g.
+        select(30e6, 1e9, polarity='V', where=lambda m: m['height'] > 2).
+        Only the selected rows and columns are read from disk.
+        '''
+        first = 0 if start is None else int(np.searchsorted(self.frequencies, start, 'left'))
+        last = self.points if stop is None else int(np.searchsorted(self.frequencies, stop, 'right'))
+        mask = np.ones(len(self), dtype=bool)
+        if where is not None or equals:
+            metadata = self.metadata
+            if callable(where):
+                mask &= where(metadata)
+            elif where is not None:
+                mask &= np.asarray(where, dtype=bool)
+            for name, value in equals.items():
+                mask &= metadata[name] == value
+        rows = np.flatnonzero(mask)
+        return self.frequencies[first:last], np.asarray(self.amplitudes[rows, first:last])
+
+    def close(self):
+        '''Releases the memory maps'''
+        self._amplitudes = self._metadata = None
+
+
+def _position(controller, device):
+    # A DualController reads either axis after selecting it
+    selected = getattr(controller, 'readable_device', device)
+    if selected != device:
+        controller.device = device
+    try:
+        return controller.read_position()
+    finally:
+        if selected != device:
+            controller.device = selected
@@ -0,0 +1,92 @@
+from pyemi.lazy import LazyModule
+
+np = LazyModule('numpy', globals(), 'np')
+
+
+def read_binary_block(resource, dtype='float32', out=None, chunk_size=None, expect_termination=True):
+    '''Reads an IEEE 488.2 definite length block (#<n><length><data>) into a numpy array.
+
+    The payload is read straight into out, or a new array sized from the
+    block header, without building an intermediate list of values.  Use
+    chunk_size to read very large blocks in pieces.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.byteorder == '=':
+        # Instruments send little endian data unless FORM:BORD NORM is set
+        dtype = dtype.newbyteorder('<')
+
+    length = read_block_header(resource)
+    if length is None:
+        # Indefinite length block, the rest of the message is data
+        data = resource.read_raw().rstrip(b'\n')
+        length = len(data) - len(data) % dtype.itemsize
+        return _copy_into(np.frombuffer(data, dtype=dtype, count=length // dtype.itemsize), out)
+
+    points = length // dtype.itemsize
+    if out is None:
+        out = np.empty(points, dtype=dtype)
+    return read_block_data(resource, length, out, dtype, chunk_size, expect_termination)
+
+
+def read_block_header(resource):
+    '''Reads a block header and returns the data length in bytes, None for an indefinite length block'''
+    header = resource.read_bytes(2)
+    if header[:1] != b'#':
+        raise ValueError(f'Expected binary block header, got {header!r}')
+    digits = int(header[1:2])
+    if digits == 0:
+        return None
+    return int(resource.read_bytes(digits))
+
+
+def read_block_data(resource, length, out, dtype='float32', chunk_size=None, expect_termination=True):
+    '''Reads length bytes of block data following the header straight into out'''
+    dtype = np.dtype(dtype)
+    if dtype.byteorder == '=':
+        dtype = dtype.newbyteorder('<')
+    points = length // dtype.itemsize
+    if out.size != points or out.dtype.itemsize != dtype.itemsize:
+        raise ValueError(f'Block holds {points} {dtype} points, output buffer holds {out.size} {out.dtype}')
+    buffer = out.reshape(-1).view(np.uint8)
+
+    chunk_size = chunk_size or length
+    position = 0
+    while position < length:
+        chunk = resource.read_bytes(min(chunk_size, length - position))
+        buffer[position:position + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+        position += len(chunk)
+
+    if expect_termination:
+        resource.read_bytes(1)
+    if out.dtype != dtype:
+        # Reading into a native buffer on a big endian host
+        out[...] = out.view(dtype)
+    return out
+
+
+def write_binary_block(resource, command, values, dtype='float64'):
+    '''Writes command followed by values as an IEEE 488.2 definite length block in one message'''
+    dtype = np.dtype(dtype)
+    if dtype.byteorder == '=':
+        dtype = dtype.newbyteorder('<')
+    data = np.ascontiguousarray(values, dtype=dtype).tobytes()
+    length = str(len(data)).encode()
+    termination = (getattr(resource, 'write_termination', None) or '').encode()
+    message = command.encode() + b' #' + str(len(length)).encode() + length + data + termination
+    resource.write_raw(message)
+    return len(message)
+
+
+def parse_ascii(data, dtype='float32', out=None):
+    '''Parses a comma separated ASCII response into a numpy array in a single pass'''
+    values = np.fromstring(data.strip().replace('\n', ','), dtype=dtype, sep=',')
+    return _copy_into(values, out)
+
+
+def _copy_into(values, out):
+    if out is None:
+        return values
+    if out.size != values.size:
+        raise ValueError(f'Response holds {values.size} points, output buffer holds {out.size}')
+    out[...] = values.reshape(out.shape)
+    return out